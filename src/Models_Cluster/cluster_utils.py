@@ -42,6 +42,10 @@ def get_cluster_businesses(cluster, conn):
     cursor.execute('''SELECT business_id, score FROM cluster_item_index WHERE cluster = ?''', (cluster,))
     return cursor.fetchall()
 
+# index -> business id list of a {business_id: idx} mapping (built with enumerate, so in index order)
+def business_ids_of(business_mapping):
+    return list(business_mapping.keys()) if isinstance(business_mapping, dict) else business_mapping
+
 def get_top_k_similar_businesses(business_id, business_mapping, conn, k=100):
     cursor = conn.cursor()
     cursor.execute('''SELECT similarity_vector FROM item_item_similarity WHERE item_id = ?''', (business_id,))
@@ -57,11 +61,14 @@ def get_top_k_similar_businesses(business_id, business_mapping, conn, k=100):
     top_k = sorted(zip(indices, data), key=lambda x: -x[1])[:k]
 
     # Map indices to business ids
-    similar_businesses = [(list(business_mapping.keys())[idx], score) for idx, score in top_k]
+    business_ids = business_ids_of(business_mapping)
+    similar_businesses = [(business_ids[idx], score) for idx, score in top_k]
 
     return similar_businesses
 
 def predict_cluster_interests(cluster, business_mapping, conn, k=100):
+    # one id list for all the cluster businesses, not one per get_top_k_similar_businesses call
+    business_mapping = business_ids_of(business_mapping)
     cluster_businesses = get_cluster_businesses(cluster, conn)
 
     recommended_businesses = {}
@@ -79,6 +86,7 @@ def predict_cluster_interests(cluster, business_mapping, conn, k=100):
     return recommended_businesses[:k]
 
 def simulate_recommendations(test_data_grouped, business_mapping, conn, k=300, num_users=10):
+    business_mapping = business_ids_of(business_mapping)
     recommendations = {}
     i = 0
     for cluster_id in test_data_grouped['cluster']:
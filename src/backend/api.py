@@ -1,11 +1,22 @@
+import os
 from flask import request, jsonify
-from models.ItemCF import ItemCF_predict_user_interests, ItemCF_predict_cluster_interests
-from models.UserCF import UserCF_predict_user_interests, UserCF_predict_cluster_interests
+from models.ItemCF import ItemCF_predict_user_interests, ItemCF_db_path
+from models.UserCF import UserCF_predict_user_interests, UserCF_db_path
+from models.Cluster import Cluster_predict_interests
 from models.DSSM import *
 from models.DeepFM import *
 from cluster import *
-from retrieve_info import retrieve_business_info, retrieve_user_info
+from retrieve_info import retrieve_business_info, retrieve_business_display_info, retrieve_user_info, Business_review_limit, Business_tip_limit, business_display_fields, info_cache_stats
+from models.cluster_index import cluster_cache_stats
+from pipeline import Pipeline
+from response_cache import cached_response, artifact_version, Response_cache
 
+# Model versions in the response cache keys: fingerprints of the artifacts loaded at startup (and the serving settings)
+ItemCF_version = artifact_version(os.path.splitext(ItemCF_db_path)[0] + "*")
+UserCF_version = artifact_version(os.path.splitext(UserCF_db_path)[0] + "*")
+DSSM_version = artifact_version(DSSM_folder_path + "*", config=[DSSM_faiss_index_type, DSSM_faiss_nprobe, DSSM_faiss_ef_search])
+
+@cached_response("ItemCF_recommendations", ItemCF_version, default_k=10)
 def get_ItemCF_recommendations():
     data = request.get_json()
     user_id = data.get('user_id')
@@ -21,6 +32,7 @@ def get_ItemCF_recommendations():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@cached_response("UserCF_recommendations", UserCF_version, default_k=10)
 def get_UserCF_recommendations():
     data = request.get_json() 
     user_id = data.get('user_id')
@@ -36,6 +48,7 @@ def get_UserCF_recommendations():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@cached_response("DSSM_recommendations", DSSM_version, default_k=10)
 def get_DSSM_recommendations():
     data = request.get_json()
     user_id = data.get('user_id')
@@ -46,41 +59,56 @@ def get_DSSM_recommendations():
     
     try:
         users = retrieve_user_info(user_id)
-        recommendations = DSSM_query_top_k(user_id, DSSM_user_model, DSSM_faiss_index, DSSM_business_ids, DSSM_user_id_encoder, DSSM_business_id_encoder, DSSM_user_scaler, DSSM_user_continuous_features_scaled, k=int(k))
+        recommendations = DSSM_recommend(user_id, int(k))
         return jsonify({"user_id": user_id, "recommendations": recommendations, "users": users}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# DeepFM ranker stage: features from the offline matrix when it has been built, otherwise from the business info
+def DeepFM_ranker(context, business_ids, k):
+    if DeepFM_business_features is not None:
+        return DeepFM_rank_top_k(DeepFM_model, context["user_id"], business_ids, context["users"], None, DeepFM_user_id_encoder, DeepFM_business_id_encoder, DeepFM_user_scaler, DeepFM_business_scaler, k=k, business_features=DeepFM_business_features)
+    # only the ranking features, not the reviews, tips and check-ins of every candidate
+    business_info = retrieve_business_info(business_ids, fields=DeepFM_business_info_fields)
+    return DeepFM_rank_top_k(DeepFM_model, context["user_id"], business_ids, context["users"], business_info, DeepFM_user_id_encoder, DeepFM_business_id_encoder, DeepFM_user_scaler, DeepFM_business_scaler, k=k)
+
+# Post-processing stage: business details of the final recommendations only
+def attach_business_info(context, recommendations):
+    recommended_business_ids = [business_id for business_id, _ in recommendations]
+    business_info = retrieve_business_display_info(recommended_business_ids)
+    context["businesses"] = {business_id: business_info[business_id] for business_id in recommended_business_ids if business_id in business_info}
+    return recommendations
+
+# ItemCF, UserCF and DSSM candidates ranked by DeepFM; budgets, timeouts and weights come from pipeline.load_pipeline_config
+DeepFM_pipeline = Pipeline(
+    sources={
+        "ItemCF": ItemCF_predict_user_interests,
+        "UserCF": UserCF_predict_user_interests,
+        "DSSM": DSSM_recommend,
+    },
+    ranker=DeepFM_ranker,
+    post_processors=[attach_business_info],
+    popularity=DeepFM_popularity)
+
+DeepFM_version = artifact_version(DeepFM_folder_path + "*", config=[DeepFM_pipeline.config, ItemCF_version, UserCF_version, DSSM_version])
+
+# the per-source and per-stage timings describe one run, so a cached answer leaves them out
+@cached_response("DeepFM_recommendations", DeepFM_version, uncached_fields=("sources", "stages"))
 def get_DeepFM_recommendations():
     data = request.get_json()
     user_id = data.get('user_id')
-    
-    # get results from ItemCF
-    ItemCF_k = 300
-    ItemCF_recommendations = ItemCF_predict_user_interests(user_id, ItemCF_k)
-
-    UserCF_k = 500
-    UserCF_recommendations = UserCF_predict_user_interests(user_id, UserCF_k)
 
-    # get results from DSSM
-    DSSM_k = 5000
-    DSSM_recommendations = DSSM_query_top_k(user_id, DSSM_user_model, DSSM_faiss_index, DSSM_business_ids, DSSM_user_id_encoder, DSSM_business_id_encoder, DSSM_user_scaler, DSSM_user_continuous_features_scaled, k=DSSM_k)
-
-    # combine the results into unique business ids
-    business_ids = [business_id for business_id, _ in ItemCF_recommendations + DSSM_recommendations + UserCF_recommendations]
-    
-    business_ids = list(set(business_ids))
     try:
         user_info = retrieve_user_info(user_id)
-        business_info = retrieve_business_info(business_ids)
-
-        # use DeepFM to rank the businesses
-        recommended_businesses = DeepFM_rank_top_k(DeepFM_model, user_id, business_ids, user_info, business_info, DeepFM_user_id_encoder, DeepFM_business_id_encoder, DeepFM_user_scaler, DeepFM_business_scaler, k=100)
-
-        recommended_business_ids = [business_id for business_id, _ in recommended_businesses]
-        business_infos = {business_id: business_info[business_id] for business_id in recommended_business_ids if business_id in business_info}
-
-        return jsonify({"user_id": user_id, "recommendations": recommended_businesses, "users": user_info, "businesses":business_infos}), 200
+        result = DeepFM_pipeline.run(user_id, {"users": user_info})
+        if not result["recommendations"]:
+            return jsonify({"error": "No candidates retrieved", "sources": result["sources"], "stages": result["stages"]}), 500
+
+        response = jsonify({"user_id": user_id, "recommendations": result["recommendations"], "users": user_info, "businesses": result["context"]["businesses"], "sources": result["sources"], "stages": result["stages"]})
+        # answers degraded by a source or ranker timeout are not cached
+        if any(source["status"] != "ok" for source in result["sources"].values()) or any(stage.get("status", "ok") != "ok" for stage in result["stages"]):
+            response.cache_control.no_store = True
+        return response, 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
     
@@ -88,15 +116,8 @@ def get_Cluster_recommendations():
     data = request.get_json()
     categories = data.get('categories')
     k = data.get('k', 10)
-    ItemCF_recommendations = ItemCF_predict_cluster_interests(categories, k)
-    UserCF_recommendations = UserCF_predict_cluster_interests(categories)
-
-    ItemCF_business_ids = set([business_id for business_id, _ in ItemCF_recommendations])
-    UserCF_business_ids = set([business_id for business_id, _ in UserCF_recommendations])
-    UserCF_business_ids = UserCF_business_ids - ItemCF_business_ids
-    UserCF_recommendations = [(business_id, score) for business_id, score in UserCF_recommendations if business_id in UserCF_business_ids]
-    # combine the two recommendations
-    recommendations = ItemCF_recommendations + UserCF_recommendations
+    # served from the precomputed per-cluster table when available
+    recommendations = Cluster_predict_interests(categories, int(k))
     return jsonify({'recommendations': recommendations}), 200 
 
 def get_business_info():
@@ -107,10 +128,19 @@ def get_business_info():
         return jsonify({"error": "No business IDs provided"}), 400
     
     business_ids_list = business_ids.split(',')  # Split comma-separated business IDs
+    # Newest reviews / tips per business (null for all); pass back a business's review_cursor / tip_cursor for the next page
+    review_limit = data.get('review_limit', Business_review_limit)
+    tip_limit = data.get('tip_limit', Business_tip_limit)
+    cursors = data.get('cursors', [])
+    # Check-in histograms by default, the raw check-in rows as well with raw_checkins
+    fields = business_display_fields + (['checkins'] if data.get('raw_checkins') else [])
     
     try:
-        business_info_dict = retrieve_business_info(business_ids_list)
+        business_info_dict = retrieve_business_info(business_ids_list, fields=fields, review_limit=None if review_limit is None else int(review_limit),
+                                                    tip_limit=None if tip_limit is None else int(tip_limit), cursors=cursors)
         return jsonify(business_info_dict), 200 
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
     
@@ -125,4 +155,8 @@ def get_user_info():
         user_info = retrieve_user_info(user_id)
         return jsonify(user_info), 200
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
\ No newline at end of file
+        return jsonify({"error": str(e)}), 500
+
+def get_cache_stats():
+    # Hit rates and sizes of the in-process caches
+    return jsonify({**info_cache_stats(), "clusters": cluster_cache_stats(), "responses": Response_cache.stats()}), 200
@@ -0,0 +1,126 @@
+import sqlite3
+from retrieve_info import db_path_business, db_path_review, db_path_user, db_path_tip
+
+# Indexes for the lookups retrieve_info issues, per database: (name, table, columns).
+# Lookups by a table's primary key (business_details, user_data) already have its automatic index.
+# Where a query reads few columns the index covers them, so the table is not visited at all.
+Serving_indexes = {
+    db_path_business: [
+        ("idx_business_categories_business_id", "business_categories", ["business_id", "category"]),
+        ("idx_checkin_data_business_id", "checkin_data", ["business_id", "checkin_date"]),
+    ],
+    db_path_review: [
+        # covers the avg_review aggregate without the totals table
+        ("idx_review_data_business_id", "review_data", ["business_id", "stars"]),
+        # newest-first pages: scanned backwards, it yields (date DESC, rowid DESC) without a sort
+        ("idx_review_data_business_date", "review_data", ["business_id", "date"]),
+    ],
+    db_path_tip: [
+        ("idx_tip_data_business_date", "tip_data", ["business_id", "date"]),
+    ],
+    db_path_user: [],
+}
+
+# Indexes made redundant by later ones: (name, replaced by)
+Retired_indexes = {
+    db_path_business: [],
+    db_path_review: [],
+    db_path_tip: [("idx_tip_data_business_id", "idx_tip_data_business_date")],
+    db_path_user: [],
+}
+
+# Per-business totals read instead of counting rows: (table, columns, SELECT filling it).
+# Rebuilt on every run so they follow data refreshes.
+Summary_tables = {
+    db_path_business: [],
+    db_path_review: [
+        ("business_review_stats", "business_id TEXT PRIMARY KEY, review_count INTEGER, avg_stars REAL",
+         "SELECT business_id, COUNT(*), AVG(stars) FROM review_data GROUP BY business_id"),
+    ],
+    db_path_tip: [
+        ("business_tip_stats", "business_id TEXT PRIMARY KEY, tip_count INTEGER",
+         "SELECT business_id, COUNT(*) FROM tip_data GROUP BY business_id"),
+    ],
+    db_path_user: [],
+}
+
+# The serving queries (one id bound, and the temp-table form used for bulk lookups) whose plans are reported
+Serving_queries = {
+    db_path_business: [
+        "SELECT b.business_id, b.name, b.stars, b.review_count FROM business_details b WHERE b.business_id IN (?)",
+        "SELECT business_id, category FROM business_categories WHERE business_id IN (?)",
+        "SELECT business_id, category FROM business_categories WHERE business_id IN (SELECT id FROM temp.lookup_ids)",
+        "SELECT business_id, checkin_date FROM checkin_data WHERE business_id IN (?)",
+    ],
+    db_path_review: [
+        "SELECT business_id, AVG(stars) FROM review_data WHERE business_id IN (?) GROUP BY business_id",
+        "SELECT rowid, review_id, user_id, stars, date, text, useful, funny, cool FROM review_data WHERE business_id = ? ORDER BY date DESC, rowid DESC LIMIT ?",
+        "SELECT rowid, review_id, user_id, stars, date, text, useful, funny, cool FROM review_data WHERE business_id = ? AND (date, rowid) < (?, ?) ORDER BY date DESC, rowid DESC LIMIT ?",
+        "SELECT business_id, review_id, user_id, stars, date, text, useful, funny, cool FROM review_data WHERE business_id IN (SELECT id FROM temp.lookup_ids) ORDER BY business_id, date DESC, rowid DESC",
+    ],
+    db_path_tip: [
+        "SELECT rowid, user_id, text, date, compliment_count FROM tip_data WHERE business_id = ? ORDER BY date DESC, rowid DESC LIMIT ?",
+        "SELECT business_id, COUNT(*) FROM tip_data WHERE business_id IN (?) GROUP BY business_id",
+    ],
+    db_path_user: [
+        "SELECT user_id, name, review_count FROM user_data WHERE user_id IN (?)",
+    ],
+}
+
+def query_plan(conn, query):
+    params = [""] * query.count("?")
+    return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + query, params)]
+
+def query_plans(conn, queries):
+    # bulk lookups join against the connection's temp table (see models.connections.IdFilter)
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS lookup_ids (id TEXT PRIMARY KEY)")
+    return {query: query_plan(conn, query) for query in queries}
+
+def existing_indexes(conn, table):
+    indexes = {}
+    for _, name, *_ in conn.execute(f"PRAGMA index_list({table})"):
+        indexes[name] = [row[2] for row in conn.execute(f"PRAGMA index_info({name})")]
+    return indexes
+
+# Create the missing indexes, rebuild the summary tables and ANALYZE; running it again changes no index.
+# The backend opens the databases as immutable, so stop it while migrating and restart it afterwards.
+def migrate_database(db_path, indexes, queries, retired=(), summaries=(), dry_run=False):
+    conn = sqlite3.connect(db_path)
+    try:
+        report = {"db_path": db_path, "created": [], "existing": [], "conflicts": [], "dropped": [], "summaries": []}
+        report["before"] = query_plans(conn, queries)
+
+        for name, table, columns in indexes:
+            current = existing_indexes(conn, table)
+            if name in current:
+                (report["existing"] if current[name] == columns else report["conflicts"]).append((name, table, current[name]))
+                continue
+            if not dry_run:
+                conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})")
+            report["created"].append((name, table, columns))
+
+        present = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        for name, replacement in retired:
+            if name in present:
+                if not dry_run:
+                    conn.execute(f"DROP INDEX IF EXISTS {name}")
+                report["dropped"].append((name, replacement))
+
+        for table, columns, select in summaries:
+            if not dry_run:
+                conn.execute(f"DROP TABLE IF EXISTS {table}")
+                conn.execute(f"CREATE TABLE {table} ({columns})")
+                conn.execute(f"INSERT INTO {table} {select}")
+            report["summaries"].append(table)
+
+        if not dry_run:
+            conn.execute("ANALYZE")
+            conn.commit()
+        report["after"] = query_plans(conn, queries)
+        return report
+    finally:
+        conn.close()
+
+def migrate(dry_run=False):
+    return [migrate_database(db_path, Serving_indexes[db_path], Serving_queries[db_path], Retired_indexes[db_path], Summary_tables[db_path], dry_run)
+            for db_path in Serving_indexes]
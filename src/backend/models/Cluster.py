@@ -0,0 +1,66 @@
+import os
+import pickle
+import numpy as np
+from .ItemCF import ItemCF_predict_cluster_interests, ClusterItemCF_engine, ClusterItemCF_db_path
+from .UserCF import UserCF_predict_cluster_interests, ClusterUserCF_db_path
+from .utils import find_cluster_id
+from .cluster_index import get_cluster_assigner, ClusterAssigner
+
+Cluster_recommendations_path = "../../data/processed_data/cluster_data/cluster_recommendations.pkl"
+
+# Largest ItemCF k stored per cluster; larger requests are computed live
+Cluster_ItemCF_k = 100
+
+# ItemCF results first, then the UserCF results that ItemCF did not already return
+def merge_cluster_recommendations(ItemCF_recommendations, UserCF_recommendations):
+    ItemCF_business_ids = set([business_id for business_id, _ in ItemCF_recommendations])
+    UserCF_recommendations = [(business_id, score) for business_id, score in UserCF_recommendations if business_id not in ItemCF_business_ids]
+    return ItemCF_recommendations + UserCF_recommendations
+
+# Modification times of the clustering and the ClusterItemCF / ClusterUserCF databases the table is built from
+def cluster_recommendations_version():
+    return (ClusterAssigner.files_version(get_cluster_assigner().folder_path),
+            os.path.getmtime(ClusterItemCF_db_path),
+            os.path.getmtime(ClusterUserCF_db_path))
+
+# Offline: ItemCF and UserCF lists for every cluster
+def build_cluster_recommendations(k=Cluster_ItemCF_k):
+    version = cluster_recommendations_version()
+    clusters = sorted(set(int(cluster) for cluster in get_cluster_assigner().clustered_user_df['cluster']))
+    table = {}
+    for cluster in clusters:
+        table[cluster] = {
+            "ItemCF": ItemCF_predict_cluster_interests(None, k, cluster=cluster),
+            "UserCF": UserCF_predict_cluster_interests(None, cluster_id=cluster),
+        }
+    # Below the longest neighbour list, ItemCF truncates neighbours to k and a prefix of the k list is no longer exact
+    exact_from_k = int(np.diff(ClusterItemCF_engine.similarity.indptr).max(initial=0))
+    return {"k": k, "exact_from_k": exact_from_k, "clusters": table, "version": version}
+
+def save_cluster_recommendations(recommendations, path=Cluster_recommendations_path):
+    with open(path, 'wb') as f:
+        pickle.dump(recommendations, f)
+
+def load_cluster_recommendations(path=Cluster_recommendations_path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+# Loaded once at startup (None until the offline job has been run)
+Cluster_recommendations = load_cluster_recommendations()
+
+# The table is only served while its sources are unchanged: a new clustering renumbers the clusters
+def cluster_recommendations_current(table):
+    return table is not None and table.get("version") == cluster_recommendations_version()
+
+def Cluster_predict_interests(categories, k=10):
+    cluster = find_cluster_id(categories)
+    table = Cluster_recommendations
+    if cluster_recommendations_current(table) and (k == table["k"] or table["exact_from_k"] <= k <= table["k"]) and cluster in table["clusters"]:
+        entry = table["clusters"][cluster]
+        return merge_cluster_recommendations(entry["ItemCF"][:k], entry["UserCF"])
+
+    ItemCF_recommendations = ItemCF_predict_cluster_interests(categories, k, cluster=cluster)
+    UserCF_recommendations = UserCF_predict_cluster_interests(categories, cluster_id=cluster)
+    return merge_cluster_recommendations(ItemCF_recommendations, UserCF_recommendations)
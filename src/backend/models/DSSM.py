@@ -1,26 +1,53 @@
+import os
 import numpy as np
 import pickle
-import faiss
-from tensorflow.keras.models import load_model
+import queue
+import threading
+import time
+from concurrent.futures import Future
 from sklearn.preprocessing import normalize
+from .faiss_index import load_faiss_index
+from .id_mapping import IdMapping, as_id_mapping
+from .numpy_inference import NumpyUserTower, max_abs_difference
 
 DSSM_folder_path = "../../data/processed_data/DSSM/"
 
 # Load business IDs
 DSSM_business_ids = np.load(DSSM_folder_path + "business_ids.npy")
 
+# Faiss index variant to serve from (flat, ivf_flat, ivf_pq or hnsw, see offline_jobs.py faiss-index)
+# and its search parameters, set with $DSSM_FAISS_INDEX, $DSSM_FAISS_NPROBE and $DSSM_FAISS_EF_SEARCH.
+# nprobe applies to the IVF variants, efSearch to HNSW
+DSSM_faiss_index_type = os.environ.get("DSSM_FAISS_INDEX", "flat")
+DSSM_faiss_nprobe = int(os.environ.get("DSSM_FAISS_NPROBE", 32))
+DSSM_faiss_ef_search = int(os.environ.get("DSSM_FAISS_EF_SEARCH", 256))
+
 # Load the Faiss index from the file
-DSSM_faiss_index = faiss.read_index(DSSM_folder_path + "faiss_index.bin")
+DSSM_faiss_index = load_faiss_index(DSSM_folder_path, DSSM_faiss_index_type, DSSM_faiss_nprobe, DSSM_faiss_ef_search)
+
+DSSM_user_model_path = DSSM_folder_path + 'user_model.keras'
+DSSM_user_tower_path = DSSM_folder_path + 'user_tower.npz'
+
+def load_keras_user_model():
+    from tensorflow.keras.models import load_model
+    return load_model(DSSM_user_model_path)
+
+# NumPy user tower when its weights were exported from the current Keras model (offline_jobs.py dssm-user-tower),
+# otherwise the Keras model itself
+def load_user_model():
+    if os.path.exists(DSSM_user_tower_path) and os.path.getmtime(DSSM_user_tower_path) >= os.path.getmtime(DSSM_user_model_path):
+        return NumpyUserTower.load(DSSM_user_tower_path)
+    return load_keras_user_model()
 
 # Load the user model
-DSSM_user_model = load_model(DSSM_folder_path + 'user_model.keras')
+DSSM_user_model = load_user_model()
 
-# Load the saved label encoders
+# Load the saved label encoders (served as hash lookups with the LabelEncoder interface)
 with open(DSSM_folder_path + 'user_id_encoder.pkl', 'rb') as f:
-    DSSM_user_id_encoder = pickle.load(f)
+    DSSM_user_id_encoder = IdMapping.from_label_encoder(pickle.load(f))
 
 with open(DSSM_folder_path + 'business_id_encoder.pkl', 'rb') as f:
-    DSSM_business_id_encoder = pickle.load(f)
+    DSSM_business_id_encoder = IdMapping.from_label_encoder(pickle.load(f))
 
 # Load the saved scalers
 with open(DSSM_folder_path + 'user_scaler.pkl', 'rb') as f:
@@ -30,29 +57,162 @@ with open(DSSM_folder_path + 'user_scaler.pkl', 'rb') as f:
 with open(DSSM_folder_path + 'user_continuous_features_scaled.pkl', 'rb') as f:
     DSSM_user_continuous_features_scaled = pickle.load(f)
 
-def DSSM_query_top_k(user_id, user_model, faiss_index, business_ids, user_id_encoder, business_id_encoder, user_scaler, user_continuous_features_scaled, k=100):
-    # Check if the user_id is in the user_id_encoder
-    if user_id not in user_id_encoder.classes_:
-        raise ValueError("User ID is not in the encoder")
+DSSM_user_embeddings_path = DSSM_folder_path + "user_embeddings.npy"
 
-    # Encode user_id and get continuous features
-    user_id_encoded = user_id_encoder.transform([user_id])[0]
+# Embed a batch of (known) users with a single predict call
+def DSSM_embed_users(user_ids, user_model, user_id_encoder, user_scaler, user_continuous_features_scaled):
+    user_ids_encoded = user_id_encoder.transform(user_ids)
     user_cont_features = user_scaler.transform(
-        user_continuous_features_scaled.loc[[user_id_encoded]].values
+        user_continuous_features_scaled.loc[user_ids_encoded].values
     )
-    # Predict the user's embedding
-    user_embedding = user_model.predict([np.array([user_id_encoded]), user_cont_features])
-    user_embedding_normalized = normalize(user_embedding, axis=1)
+    user_embeddings = user_model.predict([np.asarray(user_ids_encoded), user_cont_features], verbose=0)
+    return normalize(user_embeddings, axis=1).astype(np.float32)
+
+# Offline: L2-normalized embedding of every user, row i = encoded user id i
+def export_user_embeddings(path=DSSM_user_embeddings_path, batch_size=4096):
+    user_ids = DSSM_user_id_encoder.classes_
+    embeddings = None
+    tmp_path = path + ".tmp.npy"
+    for start in range(0, len(user_ids), batch_size):
+        batch = DSSM_embed_users(user_ids[start:start + batch_size], DSSM_user_model, DSSM_user_id_encoder, DSSM_user_scaler, DSSM_user_continuous_features_scaled)
+        if embeddings is None:
+            embeddings = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(len(user_ids), batch.shape[1]))
+        embeddings[start:start + len(batch)] = batch
+    embeddings.flush()
+    del embeddings
+    os.replace(tmp_path, path)
+    return len(user_ids)
+
+# Offline: export the Keras user tower weights and check the NumPy forward pass against Keras on a sample of users
+def export_user_tower(path=DSSM_user_tower_path, num_users=1000, seed=0):
+    keras_user_model = load_keras_user_model()
+    NumpyUserTower.export(keras_user_model, path)
+    return check_user_tower(path, num_users, seed, keras_user_model)
+
+# Largest |NumPy - Keras| user embedding difference of an exported user tower, over num_users sampled users
+def check_user_tower(path=DSSM_user_tower_path, num_users=1000, seed=0, keras_user_model=None):
+    keras_user_model = load_keras_user_model() if keras_user_model is None else keras_user_model
+    rng = np.random.default_rng(seed)
+    user_ids_encoded = rng.choice(len(DSSM_user_id_encoder), size=min(num_users, len(DSSM_user_id_encoder)), replace=False)
+    user_cont_features = DSSM_user_scaler.transform(DSSM_user_continuous_features_scaled.loc[user_ids_encoded].values)
+    inputs = [user_ids_encoded, user_cont_features]
+    return max_abs_difference(keras_user_model, NumpyUserTower.load(path), inputs), len(user_ids_encoded)
+
+# Memory-mapped embedding table; ignored if missing or older than the user model it was exported from
+def load_user_embeddings(path=DSSM_user_embeddings_path):
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(DSSM_user_model_path):
+        return None
+    return np.load(path, mmap_mode='r')
+
+DSSM_user_embeddings = load_user_embeddings()
+
+# Row lookup in the exported table, the user model only for users the table does not cover
+def DSSM_lookup_user_embeddings(user_ids, user_model, user_id_encoder, user_scaler, user_continuous_features_scaled, user_embeddings=None):
+    if user_embeddings is None:
+        return DSSM_embed_users(user_ids, user_model, user_id_encoder, user_scaler, user_continuous_features_scaled)
+
+    user_ids_encoded = user_id_encoder.transform(user_ids)
+    in_table = user_ids_encoded < len(user_embeddings)
+    embeddings = np.empty((len(user_ids), user_embeddings.shape[1]), dtype=np.float32)
+    embeddings[in_table] = user_embeddings[user_ids_encoded[in_table]]
+    if not in_table.all():
+        missing = np.flatnonzero(~in_table)
+        embeddings[missing] = DSSM_embed_users([user_ids[i] for i in missing], user_model, user_id_encoder, user_scaler, user_continuous_features_scaled)
+    return embeddings
+
+def DSSM_query_top_k_batch(user_ids, user_model, faiss_index, business_ids, user_id_encoder, business_id_encoder, user_scaler, user_continuous_features_scaled, k=100, user_embeddings=None):
+    user_id_encoder = as_id_mapping(user_id_encoder)
+    business_id_encoder = as_id_mapping(business_id_encoder)
 
-    # Perform ANN search using Faiss
-    similarity, indices = faiss_index.search(user_embedding_normalized, k)
+    # Check if every user_id is in the user_id_encoder
+    unknown_user_ids = [user_id for user_id in user_ids if user_id not in user_id_encoder]
+    if unknown_user_ids:
+        raise ValueError(f"User IDs are not in the encoder: {unknown_user_ids}")
+    if len(user_ids) == 0:
+        return []
 
-    # Return top-k businesses and distances
+    # One embedding lookup (or predict call) and one ANN search for the whole batch
+    embeddings = DSSM_lookup_user_embeddings(user_ids, user_model, user_id_encoder, user_scaler, user_continuous_features_scaled, user_embeddings)
+    similarity, indices = faiss_index.search(embeddings, k)
+
+    # Decode business IDs back to their original format (one inverse_transform for the batch)
     top_k_business_ids = business_ids[indices.flatten()]
+    decoded_business_ids = business_id_encoder.inverse_transform(top_k_business_ids).reshape(indices.shape)
+
+    # One list of (business_id, similarity) tuples per user; approximate indexes pad short results with -1
+    found = indices >= 0
+    return [list(zip(decoded_business_ids[i][found[i]].tolist(), similarity[i][found[i]].tolist())) for i in range(len(user_ids))]
+
+def DSSM_query_top_k(user_id, user_model, faiss_index, business_ids, user_id_encoder, business_id_encoder, user_scaler, user_continuous_features_scaled, k=100, user_embeddings=None):
+    # Check if the user_id is in the user_id_encoder
+    if user_id not in as_id_mapping(user_id_encoder):
+        raise ValueError("User ID is not in the encoder")
+
+    return DSSM_query_top_k_batch([user_id], user_model, faiss_index, business_ids, user_id_encoder, business_id_encoder, user_scaler, user_continuous_features_scaled, k, user_embeddings)[0]
+
+class DSSMMicroBatcher:
+    # Merges concurrent single-user queries that arrive within max_wait_ms into one batched query.
+    # Each batch is searched with the largest k asked for and cut per request (Faiss results are sorted).
+    def __init__(self, query_batch, max_batch_size=64, max_wait_ms=3):
+        self.query_batch = query_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="DSSMMicroBatcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, user_id, k=100):
+        future = Future()
+        self.queue.put((user_id, k, future))
+        return future
+
+    def query(self, user_id, k=100, timeout=None):
+        return self.submit(user_id, k).result(timeout)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._process(batch)
+
+    def _process(self, batch):
+        # Unknown users fail on their own instead of failing the whole batch
+        requests = []
+        for user_id, k, future in batch:
+            if not future.set_running_or_notify_cancel():
+                continue
+            if user_id not in DSSM_user_id_encoder:
+                future.set_exception(ValueError("User ID is not in the encoder"))
+            else:
+                requests.append((user_id, k, future))
+        if not requests:
+            return
+
+        try:
+            results = self.query_batch([user_id for user_id, _, _ in requests], max(k for _, k, _ in requests))
+        except Exception as e:
+            for _, _, future in requests:
+                future.set_exception(e)
+            return
+        for (_, k, future), recommendations in zip(requests, results):
+            future.set_result(recommendations[:k])
+
+def DSSM_recommend_batch(user_ids, k=100):
+    return DSSM_query_top_k_batch(user_ids, DSSM_user_model, DSSM_faiss_index, DSSM_business_ids, DSSM_user_id_encoder, DSSM_business_id_encoder, DSSM_user_scaler, DSSM_user_continuous_features_scaled, k, DSSM_user_embeddings)
 
-    # Decode business IDs back to their original format
-    decoded_business_ids = business_id_encoder.inverse_transform(top_k_business_ids)
+# Opt-in with $DSSM_MICRO_BATCHING=1: route single-user requests through the micro-batcher (worth it under concurrent load)
+DSSM_micro_batching = os.environ.get("DSSM_MICRO_BATCHING", "0").lower() in ("1", "true", "yes")
+DSSM_micro_batcher = DSSMMicroBatcher(DSSM_recommend_batch) if DSSM_micro_batching else None
 
-    # Convert them into a list of tuples for JSON serialization
-    recommended_businesses = list(zip(decoded_business_ids.tolist(), similarity.flatten().tolist()))
-    return recommended_businesses
+def DSSM_recommend(user_id, k=100):
+    if DSSM_micro_batcher is not None:
+        return DSSM_micro_batcher.query(user_id, k)
+    return DSSM_query_top_k(user_id, DSSM_user_model, DSSM_faiss_index, DSSM_business_ids, DSSM_user_id_encoder, DSSM_business_id_encoder, DSSM_user_scaler, DSSM_user_continuous_features_scaled, k, DSSM_user_embeddings)
@@ -1,19 +1,35 @@
+import os
 import numpy as np
 import pandas as pd
 import pickle
-from tensorflow.keras.models import load_model
+import sqlite3
+from .id_mapping import IdMapping, as_id_mapping
+from .numpy_inference import NumpyDeepFM, max_abs_difference
 
 DeepFM_folder_path = "../../data/processed_data/DeepFM/"
+DeepFM_model_path = DeepFM_folder_path + 'DeepFM.keras'
+DeepFM_weights_path = DeepFM_folder_path + 'DeepFM.npz'
+
+def load_keras_DeepFM_model():
+    from tensorflow.keras.models import load_model
+    return load_model(DeepFM_model_path)
+
+# NumPy engine when its weights were exported from the current Keras model (offline_jobs.py deepfm-engine),
+# otherwise the Keras model itself
+def load_DeepFM_model():
+    if os.path.exists(DeepFM_weights_path) and os.path.getmtime(DeepFM_weights_path) >= os.path.getmtime(DeepFM_model_path):
+        return NumpyDeepFM.load(DeepFM_weights_path)
+    return load_keras_DeepFM_model()
 
 # Load the DeepFM model
-DeepFM_model = load_model(DeepFM_folder_path + 'DeepFM.keras')
+DeepFM_model = load_DeepFM_model()
 
-# Load the saved label encoders
+# Load the saved label encoders (served as hash lookups with the LabelEncoder interface)
 with open(DeepFM_folder_path + 'user_id_encoder.pkl', 'rb') as f:
-    DeepFM_user_id_encoder = pickle.load(f)
+    DeepFM_user_id_encoder = IdMapping.from_label_encoder(pickle.load(f))
 
 with open(DeepFM_folder_path + 'business_id_encoder.pkl', 'rb') as f:
-    DeepFM_business_id_encoder = pickle.load(f)
+    DeepFM_business_id_encoder = IdMapping.from_label_encoder(pickle.load(f))
 
 # Load the saved scalers
 with open(DeepFM_folder_path + 'user_scaler.pkl', 'rb') as f:
@@ -22,7 +38,61 @@ with open(DeepFM_folder_path + 'user_scaler.pkl', 'rb') as f:
 with open(DeepFM_folder_path + 'business_scaler.pkl', 'rb') as f:
     DeepFM_business_scaler = pickle.load(f)
 
-def DeepFM_rank_top_k(DeepFM_model, user_id, business_ids, user_info, business_info, user_id_encoder, business_id_encoder, user_scaler, business_scaler, k=1000):
+DeepFM_business_features_path = DeepFM_folder_path + 'business_features.npy'
+DeepFM_business_features_columns = ["stars", "review_count", "avg_review", "latitude", "longitude"]
+
+DeepFM_db_path_business = '../../data/processed_data/yelp_data/yelp_business_data.db'
+DeepFM_db_path_review = '../../data/processed_data/yelp_data/yelp_review_data.db'
+
+# Offline: scaled business features with row i = encoded business id i.
+# Same values DeepFM_rank_top_k derives from retrieve_business_info (avg_review over all reviews, 0 when missing).
+def build_business_features(db_path_business=DeepFM_db_path_business, db_path_review=DeepFM_db_path_review):
+    with sqlite3.connect(db_path_business) as conn:
+        business_df = pd.read_sql('''SELECT business_id, stars, review_count, latitude, longitude FROM business_details''', conn)
+    with sqlite3.connect(db_path_review) as conn:
+        avg_review_df = pd.read_sql('''SELECT business_id, AVG(stars) AS avg_review FROM review_data GROUP BY business_id''', conn)
+
+    business_df = business_df.merge(avg_review_df, on='business_id', how='left').set_index('business_id')
+    business_df = business_df.reindex(DeepFM_business_id_encoder.classes_.tolist()).fillna(0)
+    business_features = DeepFM_business_scaler.transform(business_df[DeepFM_business_features_columns])
+    return business_features.astype(np.float32)
+
+def save_business_features(business_features, path=DeepFM_business_features_path):
+    tmp_path = path + ".tmp.npy"
+    np.save(tmp_path, business_features)
+    os.replace(tmp_path, path)
+
+# Memory-mapped feature matrix. None until the offline job has been run, or when the matrix is stale:
+# older than the encoder, scaler or Yelp databases it was built from, or not one row per encoded business.
+# Serving then falls back to the business features from retrieve_business_info.
+def load_business_features(path=DeepFM_business_features_path):
+    if not os.path.exists(path):
+        return None
+    sources = [DeepFM_folder_path + 'business_id_encoder.pkl', DeepFM_folder_path + 'business_scaler.pkl', DeepFM_db_path_business, DeepFM_db_path_review]
+    if any(os.path.exists(source) and os.path.getmtime(path) < os.path.getmtime(source) for source in sources):
+        return None
+    business_features = np.load(path, mmap_mode='r')
+    if business_features.shape != (len(DeepFM_business_id_encoder), len(DeepFM_business_features_columns)):
+        return None
+    return business_features
+
+DeepFM_business_features = load_business_features()
+
+# Popularity prior for the pre-ranker: the scaled review_count, 0 for unknown businesses or without the feature matrix
+def DeepFM_popularity(business_ids, business_features=None):
+    business_features = DeepFM_business_features if business_features is None else business_features
+    if business_features is None:
+        return np.zeros(len(business_ids))
+    encoded_business_ids = DeepFM_business_id_encoder.encode(business_ids)
+    known = encoded_business_ids >= 0
+    popularity = np.zeros(len(business_ids))
+    popularity[known] = business_features[encoded_business_ids[known], DeepFM_business_features_columns.index("review_count")]
+    return popularity
+
+# With business_features (see build_business_features) the business rows are gathered from it and business_info is not needed
+def DeepFM_rank_top_k(DeepFM_model, user_id, business_ids, user_info, business_info, user_id_encoder, business_id_encoder, user_scaler, business_scaler, k=1000, business_features=None):
+    user_id_encoder = as_id_mapping(user_id_encoder)
+    business_id_encoder = as_id_mapping(business_id_encoder)
 
     encoded_user_id = user_id_encoder.transform([user_id])[0]
     user_continuous_features = ['review_count', 'useful', 'funny', 'cool', 'fans', 'average_stars']
@@ -50,51 +120,26 @@ def DeepFM_rank_top_k(DeepFM_model, user_id, business_ids, user_info, business_i
     
     encoded_business_ids = business_id_encoder.transform(business_ids)
 
-    # later_features = ["name", "address", "city", "state", "postal_code",]
-    business_continuous_features = ["latitude", "longitude", "stars", 
-    "review_count"]
-
-    business_data_list = []
-    for business_id in business_info:
-        # Extract continuous features
-        business_features = [business_info[business_id].get(feat, 0) for feat in business_continuous_features]
-
-        total_reviews = 0
-        for review in business_info[business_id]['reviews']:
-            total_reviews += review['stars']
-
-        # Calculate average review
-        if len(business_info[business_id]['reviews']) > 0:
-            avg_review = total_reviews / len(business_info[business_id]['reviews'])
-        else:
-            avg_review = 0
-        # Combine into a single row
-        business_data_list.append(business_features + [avg_review])
-
-    business_continuous_features += ["avg_review"]
+    if business_features is not None:
+        business_continuous_features = pd.DataFrame(business_features[encoded_business_ids], columns=DeepFM_business_features_columns)
+    else:
+        business_continuous_features = business_features_from_info(business_ids, business_info, business_scaler)
 
-    # Convert to DataFrame
-    business_continuous_features = pd.DataFrame(business_data_list, 
-                                                columns=business_continuous_features)
-
-    ordered_business_continuous_features = ["stars", "review_count", "avg_review", "latitude", "longitude",] 
+    if isinstance(DeepFM_model, NumpyDeepFM) and len(user_continuous_features) == 1:
+        # one user: the NumPy engine computes the user part of the network once
+        predictions = DeepFM_model.score_user(user_continuous_features.values[0], encoded_user_id, business_continuous_features.values, encoded_business_ids)
+    else:
+        # combine user and business features into one dataframe (there is only one user and maybe multiple businesses)
+        user_features = np.repeat(user_continuous_features.values, len(business_continuous_features), axis=0)
+        business_rows = np.tile(business_continuous_features.values, (len(user_continuous_features), 1))
+        all_features = np.concatenate([user_features, business_rows], axis=1)
 
-    business_continuous_features = business_continuous_features[ordered_business_continuous_features]
-
-    # Scale continuous features and reorder columns
-    business_continuous_features = pd.DataFrame(business_scaler.transform(business_continuous_features), 
-                                                columns=ordered_business_continuous_features)
-    # combine user and business features into one dataframe (there is only one user and maybe multiple businesses)
-    user_features = np.repeat(user_continuous_features.values, len(business_continuous_features), axis=0)
-    business_features = np.tile(business_continuous_features.values, (len(user_continuous_features), 1))
-    all_features = np.concatenate([user_features, business_features], axis=1)
+        # get the user_ids and business_ids in the right format (i.e. -1, 1)
+        user_ids = np.repeat(encoded_user_id, len(encoded_business_ids)).reshape(-1, 1)
+        business_ids = np.array(encoded_business_ids).reshape(-1, 1)
 
-    # get the user_ids and business_ids in the right format (i.e. -1, 1)
-    user_ids = np.repeat(encoded_user_id, len(encoded_business_ids)).reshape(-1, 1)
-    business_ids = np.array(encoded_business_ids).reshape(-1, 1)
-
-    # make the prediction
-    predictions = DeepFM_model.predict([all_features, user_ids, business_ids])
+        # make the prediction
+        predictions = DeepFM_model.predict([all_features, user_ids, business_ids])
 
     # get the predictions
     predictions = predictions.flatten()
@@ -109,7 +154,62 @@ def DeepFM_rank_top_k(DeepFM_model, user_id, business_ids, user_info, business_i
     recommended_businesses = list(zip(decoded_business_ids, predictions))
     recommended_businesses.sort(key=lambda x: x[1], reverse=True)
     return recommended_businesses[:k]
-    
 
+# retrieve_business_info fields DeepFM needs without the feature matrix
+DeepFM_business_info_fields = ["stars", "review_count", "latitude", "longitude", "avg_review"]
 
+# Scaled business features built from retrieve_business_info results, one row per business_id (in that order)
+def business_features_from_info(business_ids, business_info, business_scaler):
+    # later_features = ["name", "address", "city", "state", "postal_code",]
+    business_continuous_features = ["latitude", "longitude", "stars", 
+    "review_count"]
 
+    business_data_list = []
+    for business_id in business_ids:
+        info = business_info.get(business_id, {})
+        # Extract continuous features
+        business_features = [info.get(feat, 0) for feat in business_continuous_features]
+
+        # Average review, computed in SQL when retrieved with fields=DeepFM_business_info_fields
+        if 'avg_review' in info:
+            avg_review = info['avg_review']
+        elif len(info.get('reviews', [])) > 0:
+            avg_review = sum(review['stars'] for review in info['reviews']) / len(info['reviews'])
+        else:
+            avg_review = 0
+        # Combine into a single row
+        business_data_list.append(business_features + [avg_review])
+
+    business_continuous_features += ["avg_review"]
+
+    # Convert to DataFrame
+    business_continuous_features = pd.DataFrame(business_data_list, 
+                                                columns=business_continuous_features)
+
+    business_continuous_features = business_continuous_features[DeepFM_business_features_columns]
+
+    # Scale continuous features and reorder columns
+    return pd.DataFrame(business_scaler.transform(business_continuous_features), 
+                        columns=DeepFM_business_features_columns)
+
+# Offline: export the Keras weights and check the NumPy engine against Keras on random inputs
+def export_DeepFM_engine(path=DeepFM_weights_path, num_samples=10000, seed=0):
+    keras_model = load_keras_DeepFM_model()
+    NumpyDeepFM.export(keras_model, path)
+    return check_DeepFM_engine(path, num_samples, seed, keras_model)
+
+# Largest |NumPy - Keras| score difference of the exported weights over num_samples random candidates
+def check_DeepFM_engine(path=DeepFM_weights_path, num_samples=10000, seed=0, keras_model=None):
+    keras_model = load_keras_DeepFM_model() if keras_model is None else keras_model
+    engine = NumpyDeepFM.load(path)
+    return keras_model, engine, max_abs_difference(keras_model, engine, DeepFM_random_inputs(engine, num_samples, seed))
+
+# Random (scaled-like) continuous features and valid ids for one user against num_candidates businesses
+def DeepFM_random_inputs(engine, num_candidates, seed=0):
+    rng = np.random.default_rng(seed)
+    num_continuous = engine.linear[0].shape[0]
+    user_ids = np.repeat(rng.integers(len(engine.user_embedding)), num_candidates).reshape(-1, 1)
+    business_ids = rng.integers(len(engine.business_embedding), size=num_candidates).reshape(-1, 1)
+    user_features = np.repeat(rng.normal(size=(1, DeepFM_user_scaler.n_features_in_)), num_candidates, axis=0)
+    business_features = rng.normal(size=(num_candidates, num_continuous - DeepFM_user_scaler.n_features_in_))
+    return [np.concatenate([user_features, business_features], axis=1).astype(np.float32), user_ids, business_ids]
@@ -1,65 +1,125 @@
-import pickle
-from .utils import get_db_connection, get_user_businesses, get_cluster_businesses, find_cluster_id
+import numpy as np
+from .utils import get_db_connection, get_cluster_businesses, find_cluster_id, load_similarity_matrix, load_interaction_matrix, sparse_row_product, top_k_scores
+from .connections import pooled_connection
+from .id_mapping import load_id_mapping
 
-# Retrieve user-business mappings
-def retrieve_business_mapping(conn):
-    cursor = conn.cursor()
-    cursor.execute('''SELECT business_id, business_idx FROM business_mapping''')
-    business_mapping = {row[0]: row[1] for row in cursor.fetchall()}
-    return business_mapping
+ItemCF_db_path = '../../data/processed_data/yelp_ItemCF.db'
+ClusterItemCF_db_path = '../../data/processed_data/yelp_ClusterItemCF.db'
+
+# Retrieve user-business mappings (persisted IdMapping, memory-mapped on later starts)
+def retrieve_business_mapping(conn, db_path):
+    return load_id_mapping(conn, db_path, '''SELECT business_id, business_idx FROM business_mapping''', 'business_mapping')
+
+def retrieve_user_mapping(conn, db_path):
+    return load_id_mapping(conn, db_path, '''SELECT DISTINCT user_id FROM user_item_index ORDER BY user_id''', 'user_mapping')
+
+class ItemCFEngine:
+    # Keeps the whole item_item_similarity table resident as a CSR matrix,
+    # so a request only slices rows in memory instead of querying and unpickling them
+    def __init__(self, db_path):
+        self.db_path = db_path
+        conn = get_db_connection(db_path)
+        try:
+            self.business_mapping = retrieve_business_mapping(conn, db_path)
+            self.similarity = load_similarity_matrix(conn, '''SELECT item_id, similarity_vector FROM item_item_similarity''', self.business_mapping, len(self.business_mapping))
+            # user x business matrix of stars_review, rows ordered like get_user_businesses
+            self.user_item, self.user_mapping = load_interaction_matrix(conn, '''SELECT user_id, business_id, stars_review FROM user_item_index ORDER BY user_id, business_id''', self.business_mapping, retrieve_user_mapping(conn, db_path))
+        finally:
+            conn.close()
+
+    # Indices and scores of the top-k neighbours of a business (rows are pre-sorted by score)
+    def similar_indices(self, business_id, k):
+        business_idx = self.business_mapping.get(business_id)
+        if business_idx is None:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+        start = self.similarity.indptr[business_idx]
+        end = min(self.similarity.indptr[business_idx + 1], start + k)
+        return self.similarity.indices[start:end], self.similarity.data[start:end]
+
+    def business_indices(self, business_ids):
+        business_idx = self.business_mapping.encode(business_ids)
+        return business_idx[business_idx >= 0]
+
+    # Businesses the user reviewed (as indices) and their stars_review
+    def user_history(self, user_id):
+        user_idx = self.user_mapping.get(user_id)
+        if user_idx is None:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        start, end = self.user_item.indptr[user_idx], self.user_item.indptr[user_idx + 1]
+        return self.user_item.indices[start:end].astype(np.int64), self.user_item.data[start:end]
+
+    # Vectorized scoring: (interaction vector) x (item-item similarity, top-k per row), then top-k
+    def score(self, business_idx, k, weights=None):
+        columns, scores, first_seen = sparse_row_product(self.similarity, business_idx, weights, k)
+        top = top_k_scores(scores, k, first_seen)
+        return list(zip(self.business_mapping.decode(columns[top]), scores[top].tolist()))
+
+    # Reference loop implementation, kept to check the vectorized ranking against
+    def predict_interests(self, business_ids, k):
+        recommended_businesses = {}
+        for business_id in business_ids:
+            similar_businesses = get_top_k_similar_businesses(business_id, k, self)
+
+            for similar_business_id, score in similar_businesses:
+                if similar_business_id in recommended_businesses:
+                    recommended_businesses[similar_business_id] += score
+                else:
+                    recommended_businesses[similar_business_id] = score
+
+        recommended_businesses = sorted(recommended_businesses.items(), key=lambda x: -x[1])
+        return recommended_businesses[:k]
+
+# Loaded once at startup
+ItemCF_engine = ItemCFEngine(ItemCF_db_path)
+ClusterItemCF_engine = ItemCFEngine(ClusterItemCF_db_path)
 
 # Get top-k similar businesses
-def get_top_k_similar_businesses(business_id, k, conn, business_mapping):
-    cursor = conn.cursor()
-    cursor.execute('''SELECT similarity_vector FROM item_item_similarity WHERE item_id = ?''', (business_id,))
-    result = cursor.fetchone()
-
-    if result is None:
-        return []
-    similarity_vector = pickle.loads(result[0])
-    indices, data = similarity_vector
-
-    top_k = sorted(zip(indices, data), key=lambda x: -x[1])[:k]
-    similar_businesses = [(list(business_mapping.keys())[idx], score) for idx, score in top_k]
+def get_top_k_similar_businesses(business_id, k, engine=ItemCF_engine):
+    indices, data = engine.similar_indices(business_id, k)
+    similar_businesses = list(zip(engine.business_mapping.decode(indices), data.tolist()))
     return similar_businesses
 
 # Predict user interests
-def ItemCF_predict_user_interests(user_id, k):
-    db_path = '../../data/processed_data/yelp_ItemCF.db'
-    conn = get_db_connection(db_path)
-    business_mapping = retrieve_business_mapping(conn)
-    user_businesses = get_user_businesses(user_id, conn)
-
-    recommended_businesses = {}
-    for business_id, _ in user_businesses:
-        similar_businesses = get_top_k_similar_businesses(business_id, k, conn, business_mapping)
-
-        for similar_business_id, score in similar_businesses:
-            if similar_business_id in recommended_businesses:
-                recommended_businesses[similar_business_id] += score
-            else:
-                recommended_businesses[similar_business_id] = score
-
-    recommended_businesses = sorted(recommended_businesses.items(), key=lambda x: -x[1])
-    conn.close()
-    return recommended_businesses[:k]
-
-def ItemCF_predict_cluster_interests(categories, k=100):
-    cluster = find_cluster_id(categories)
-    db_path = '../../data/processed_data/yelp_ClusterItemCF.db'
-    conn = get_db_connection(db_path)
-    business_mapping = retrieve_business_mapping(conn)
-    cluster_businesses = get_cluster_businesses(conn, '''SELECT business_id, score FROM cluster_item_index WHERE cluster = ?''', cluster)
-    recommended_businesses = {}
-    for business_id, _ in cluster_businesses:
-        similar_businesses = get_top_k_similar_businesses(business_id, k, conn, business_mapping)
-
-        for similar_business_id, score in similar_businesses:
-            if similar_business_id in recommended_businesses:
-                recommended_businesses[similar_business_id] += score
-            else:
-                recommended_businesses[similar_business_id] = score
-    # Sort recommendations by score
-    recommended_businesses = sorted(recommended_businesses.items(), key=lambda x: -x[1])
-
-    return recommended_businesses[:k]
+def ItemCF_predict_user_interests(user_id, k, weight_by_stars=False, vectorized=True):
+    business_idx, stars = ItemCF_engine.user_history(user_id)
+    if vectorized:
+        return ItemCF_engine.score(business_idx, k, stars if weight_by_stars else None)
+
+    business_ids = ItemCF_engine.business_mapping.decode(business_idx)
+    return ItemCF_engine.predict_interests(business_ids, k)
+
+# Offline parity check of the vectorized ranking against the reference loop over sampled users.
+# Scores must match position by position; ids may only differ where neighbouring scores tie.
+# Returns the number of users checked and the ids of the users whose rankings differ.
+def check_vectorized_ranking(num_users=1000, k=300, seed=0, tolerance=1e-5, engine=ItemCF_engine):
+    rng = np.random.default_rng(seed)
+    user_idx = rng.choice(len(engine.user_mapping), size=min(num_users, len(engine.user_mapping)), replace=False)
+    mismatches = []
+    for user_id in engine.user_mapping.decode(user_idx):
+        business_idx, _ = engine.user_history(user_id)
+        vectorized = engine.score(business_idx, k)
+        loop = engine.predict_interests(engine.business_mapping.decode(business_idx), k)
+        if not same_ranking(vectorized, loop, tolerance):
+            mismatches.append(user_id)
+    return len(user_idx), mismatches
+
+def same_ranking(recommendations, other, tolerance):
+    if len(recommendations) != len(other):
+        return False
+    scores = np.array([score for _, score in recommendations], dtype=np.float64)
+    if not np.allclose(scores, [score for _, score in other], rtol=tolerance, atol=tolerance):
+        return False
+    for i, ((business_id, _), (other_id, _)) in enumerate(zip(recommendations, other)):
+        tied = (i > 0 and scores[i - 1] - scores[i] <= tolerance) or (i + 1 < len(scores) and scores[i] - scores[i + 1] <= tolerance)
+        if business_id != other_id and not tied:
+            return False
+    return True
+
+def ItemCF_predict_cluster_interests(categories, k=100, cluster=None):
+    if cluster is None:
+        cluster = find_cluster_id(categories)
+    with pooled_connection(ClusterItemCF_db_path) as conn:
+        cluster_businesses = get_cluster_businesses(conn, '''SELECT business_id, score FROM cluster_item_index WHERE cluster = ?''', cluster)
+
+    business_idx = ClusterItemCF_engine.business_indices([business_id for business_id, _ in cluster_businesses])
+    return ClusterItemCF_engine.score(business_idx, k)
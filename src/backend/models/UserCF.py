@@ -1,83 +1,76 @@
-import pickle
-from .utils import get_db_connection, get_user_businesses, find_cluster_id, get_cluster_mapping, get_cluster_businesses
+import numpy as np
+from .utils import get_db_connection, find_cluster_id, get_cluster_mapping, load_similarity_matrix, load_interaction_matrix, sparse_row_product, top_k_scores
+from .id_mapping import load_id_mapping
 
-def retrieve_user_user_mapping(conn):
-    cursor = conn.cursor()
-    # Fetch user mappings
-    cursor.execute('''SELECT user_id, user_idx FROM user_mapping''')
-    user_mapping = {row[0]: row[1] for row in cursor.fetchall()}
-    return user_mapping
+UserCF_db_path = '../../data/processed_data/yelp_UserCF.db'
+ClusterUserCF_db_path = '../../data/processed_data/yelp_ClusterUserCF.db'
 
-def get_top_k_similar_users(user_id, user_mapping, k, conn):
-    cursor = conn.cursor()
-    cursor.execute('''SELECT similarity_vector FROM user_user_similarity WHERE user_id = ?''', (user_id,))
-    result = cursor.fetchone()
-    if result is None:
-        return []
-    similarity_vector = pickle.loads(result[0])
-    indices, data = similarity_vector
-    # Get top-k similar users
-    top_k = sorted(zip(indices, data), key=lambda x: -x[1])[:k]
-    # # Map indices to user ids
-    idx_to_user = {v: k for k, v in user_mapping.items()}  # Reverse mapping
-    similar_users = [(idx_to_user.get(idx, "Unknown"), score) for idx, score in top_k]
-    return similar_users
+def retrieve_user_user_mapping(conn, db_path=UserCF_db_path):
+    # Fetch user mappings (persisted IdMapping, memory-mapped on later calls)
+    return load_id_mapping(conn, db_path, '''SELECT user_id, user_idx FROM user_mapping''', 'user_mapping')
 
-def get_top_k_similar_clusters(cluster_id, cluster_mapping, k, conn):
-    if cluster_id is None or cluster_id not in cluster_mapping:
-        return []
-    cursor = conn.cursor()
-    cursor.execute('SELECT similarity_vector FROM cluster_cluster_similarity WHERE cluster_id = ?', (str(cluster_id),))
-    result = cursor.fetchone()
-    if result is None:
-        return []
-    similarity_vector = pickle.loads(result[0])
-    indices, data = similarity_vector
-    top_k = sorted(zip(indices, data), key=lambda x: -x[1])[:k]
-    idx_to_cluster = {v: str(k) for k, v in cluster_mapping.items()}  # Ensure cluster_id is string
-    similar_clusters = [(idx_to_cluster.get(idx, "Unknown"), score) for idx, score in top_k]
-    return similar_clusters
+def retrieve_business_mapping(conn, db_path):
+    return load_id_mapping(conn, db_path, '''SELECT DISTINCT business_id FROM user_item_index ORDER BY business_id''', 'business_mapping')
+
+class UserCFEngine:
+    # Keeps the user-user (or cluster-cluster) similarity and the user-item ratings resident as CSR matrices.
+    # Recommendations are a sparse product of the neighbour weights and the neighbours' rating rows.
+    def __init__(self, db_path, user_mapping, similarity_query, interaction_query, business_mapping):
+        self.db_path = db_path
+        conn = get_db_connection(db_path)
+        try:
+            self.user_mapping = user_mapping(conn, db_path)
+            self.business_mapping = business_mapping(conn, db_path)
+            self.similarity = load_similarity_matrix(conn, similarity_query, self.user_mapping, len(self.user_mapping))
+            # rows ordered like get_user_businesses, so ties rank as in the old per-neighbour loop
+            self.user_item, _ = load_interaction_matrix(conn, interaction_query, self.business_mapping, self.user_mapping)
+        finally:
+            conn.close()
 
-def UserCF_predict_user_interests(user_id, k):
-    db_path = '../../data/processed_data/yelp_UserCF.db'
-    conn = get_db_connection(db_path)
-    user_mapping = retrieve_user_user_mapping(conn)
-    # Get top-k similar users
-    similar_users = get_top_k_similar_users(user_id, user_mapping, k, conn)  # More similar users
+    # Indices and scores of the top-k similar users (rows are pre-sorted by score)
+    def similar_indices(self, user_id, k):
+        user_idx = self.user_mapping.get(str(user_id))
+        if user_idx is None:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+        start = self.similarity.indptr[user_idx]
+        end = min(self.similarity.indptr[user_idx + 1], start + k)
+        return self.similarity.indices[start:end], self.similarity.data[start:end]
 
-    recommended_businesses = {}
-    # For each similar user, get their business interactions
-    for similar_user_id, similarity_score in similar_users:
-        similar_user_businesses = get_user_businesses(similar_user_id, conn)
-        for business_id, score in similar_user_businesses:
-            # if test_businesses and business_id not in test_businesses:  # Debug: force overlap
-            #     continue
-            if business_id in recommended_businesses:
-                recommended_businesses[business_id] += score
-            else:
-                recommended_businesses[business_id] = score
-    
-    # Sort recommendations by score
-    recommended_businesses = sorted(recommended_businesses.items(), key=lambda x: -x[1])   
-    conn.close()
-    return recommended_businesses[:k]
+    def score(self, user_id, k_users, k, weight_by_similarity=False):
+        neighbours, similarity = self.similar_indices(user_id, k_users)
+        weights = similarity if weight_by_similarity else None
+        columns, scores, first_seen = sparse_row_product(self.user_item, neighbours, weights)
+        top = top_k_scores(scores, k, first_seen)
+        return list(zip(self.business_mapping.decode(columns[top]), scores[top].tolist()))
+
+# Loaded once at startup
+UserCF_engine = UserCFEngine(
+    UserCF_db_path, retrieve_user_user_mapping,
+    '''SELECT user_id, similarity_vector FROM user_user_similarity''',
+    '''SELECT user_id, business_id, stars_review FROM user_item_index ORDER BY user_id, business_id''',
+    retrieve_business_mapping)
+ClusterUserCF_engine = UserCFEngine(
+    ClusterUserCF_db_path, get_cluster_mapping,
+    '''SELECT cluster_id, similarity_vector FROM cluster_cluster_similarity''',
+    '''SELECT cluster_id, business_id, stars_review FROM cluster_item_index''',
+    lambda conn, db_path: load_id_mapping(conn, db_path, '''SELECT DISTINCT business_id FROM cluster_item_index ORDER BY business_id''', 'business_mapping'))
+
+def get_top_k_similar_users(user_id, k, engine=UserCF_engine):
+    indices, data = engine.similar_indices(user_id, k)
+    similar_users = list(zip(engine.user_mapping.decode(indices), data.tolist()))
+    return similar_users
+
+def get_top_k_similar_clusters(cluster_id, k, engine=ClusterUserCF_engine):
+    if cluster_id is None:
+        return []
+    return get_top_k_similar_users(str(cluster_id), k, engine)
 
-def UserCF_predict_cluster_interests(categories, k_clusters=10, k_items=500):
-    cluster_id = find_cluster_id(categories)
-    # convert cluster to string
-    cluster_id = str(cluster_id)
-    db_path = '../../data/processed_data/yelp_ClusterUserCF.db'
-    conn = get_db_connection(db_path)
-    cluster_mapping = get_cluster_mapping(conn)
-    similar_clusters = get_top_k_similar_clusters(cluster_id, cluster_mapping, k_clusters, conn)
+def UserCF_predict_user_interests(user_id, k, weight_by_similarity=False):
+    # k similar users, then the k businesses with the highest summed stars_review among them
+    return UserCF_engine.score(user_id, k, k, weight_by_similarity)
 
-    recommended_businesses = {}
-    for similar_cluster_id, similarity_score in similar_clusters:
-        similar_cluster_businesses = get_cluster_businesses(conn, '''SELECT business_id, stars_review FROM cluster_item_index WHERE cluster_id = ?''', similar_cluster_id)
-        for business_id, score in similar_cluster_businesses:
-            if business_id in recommended_businesses:
-                recommended_businesses[business_id] += score * similarity_score
-            else:
-                recommended_businesses[business_id] = score * similarity_score
-    recommended_businesses = sorted(recommended_businesses.items(), key=lambda x: -x[1])
-    return recommended_businesses[:k_items]
\ No newline at end of file
+def UserCF_predict_cluster_interests(categories, k_clusters=10, k_items=500, cluster_id=None):
+    if cluster_id is None:
+        cluster_id = find_cluster_id(categories)
+    # Cluster ratings are weighted by the cluster-cluster similarity
+    return ClusterUserCF_engine.score(str(cluster_id), k_clusters, k_items, weight_by_similarity=True)
@@ -0,0 +1,116 @@
+import threading
+import time
+from collections import OrderedDict
+
+class LRUCache:
+    # Thread-safe bounded LRU cache with hit/miss counters.
+    # Optionally entries expire ttl seconds after being set, and the cache is also bounded by
+    # maxbytes as measured by sizeof(value); a value larger than maxbytes is not cached.
+    def __init__(self, maxsize=1024, ttl=None, maxbytes=None, sizeof=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        # key -> (value, expiry time or None, size in bytes)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _lookup(self, key, now):
+        # caller holds the lock
+        entry = self._data.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= now:
+            self._remove(key)
+            self.expirations += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def _remove(self, key):
+        # caller holds the lock
+        _, _, size = self._data.pop(key)
+        self.bytes -= size
+
+    def _insert(self, key, value, now):
+        # caller holds the lock
+        size = self.sizeof(value) if self.sizeof is not None and self.maxbytes is not None else 0
+        if key in self._data:
+            self._remove(key)
+        if self.maxbytes is not None and size > self.maxbytes:
+            return
+        self._data[key] = (value, None if self.ttl is None else now + self.ttl, size)
+        self.bytes += size
+        while len(self._data) > self.maxsize or (self.maxbytes is not None and self.bytes > self.maxbytes):
+            _, (_, _, evicted_size) = self._data.popitem(last=False)
+            self.bytes -= evicted_size
+            self.evictions += 1
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._lookup(key, time.monotonic())
+            return default if entry is None else entry[0]
+
+    # {key: value} for the keys present; the others count as misses
+    def get_many(self, keys):
+        found = {}
+        with self._lock:
+            now = time.monotonic()
+            for key in keys:
+                entry = self._lookup(key, now)
+                if entry is not None:
+                    found[key] = entry[0]
+        return found
+
+    def set(self, key, value):
+        with self._lock:
+            self._insert(key, value, time.monotonic())
+
+    def set_many(self, items):
+        with self._lock:
+            now = time.monotonic()
+            for key, value in items.items():
+                self._insert(key, value, now)
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+    # Drop the entries whose key matches; returns how many were dropped
+    def invalidate(self, predicate):
+        with self._lock:
+            keys = [key for key in self._data if predicate(key)]
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total > 0 else 0,
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "bytes": self.bytes,
+            "maxbytes": self.maxbytes,
+            "ttl": self.ttl,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
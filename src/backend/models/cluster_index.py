@@ -0,0 +1,116 @@
+import os
+import threading
+import numpy as np
+import pandas as pd
+import pickle
+from .cache import LRUCache
+
+Cluster_folder_path = "../../data/processed_data/cluster_data/"
+
+# Number of set bits in every byte value (fallback for NumPy < 2.0)
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def popcount(packed, axis=-1):
+    if hasattr(np, 'bitwise_count'):
+        bits = np.bitwise_count(packed)
+    else:
+        bits = _POPCOUNT_TABLE[packed]
+    return bits.sum(axis=axis, dtype=np.int32)
+
+class JaccardIndex:
+    # Exact 1-NN search under Jaccard distance over binary vectors stored as packed bitsets
+    def __init__(self, features, labels, max_chunk_bytes=64 * 1024 * 1024):
+        self.packed = np.packbits(np.asarray(features) != 0, axis=1)
+        self.counts = popcount(self.packed)
+        self.labels = np.asarray(labels)
+        self.max_chunk_bytes = max_chunk_bytes
+
+    # Index of the nearest row (and its distance) for every query vector
+    def kneighbors(self, encoded):
+        queries = np.packbits(np.asarray(encoded) != 0, axis=1)
+        query_counts = popcount(queries)
+
+        # bound the (queries x rows x bytes) intermediate
+        chunk = max(1, self.max_chunk_bytes // max(1, self.packed.size))
+        indices = np.empty(len(queries), dtype=np.int64)
+        distances = np.empty(len(queries), dtype=np.float64)
+        for start in range(0, len(queries), chunk):
+            q = queries[start:start + chunk]
+            intersection = popcount(q[:, None, :] & self.packed[None, :, :])
+            union = query_counts[start:start + chunk, None] + self.counts[None, :] - intersection
+            # two empty sets are identical (distance 0), as in sklearn's jaccard metric
+            distance = np.where(union > 0, 1.0 - intersection / np.maximum(union, 1), 0.0)
+            indices[start:start + chunk] = np.argmin(distance, axis=1)
+            distances[start:start + chunk] = distance[np.arange(len(q)), indices[start:start + chunk]]
+        return distances, indices
+
+    def nearest_labels(self, encoded):
+        _, indices = self.kneighbors(encoded)
+        return self.labels[indices]
+
+class ClusterAssigner:
+    # Loads the clustered users and the category encoder once and answers
+    # "which cluster is closest to these categories" for single or batched queries
+    def __init__(self, folder_path=Cluster_folder_path):
+        self.folder_path = folder_path
+        self.version = self.files_version(folder_path)
+        self.clustered_user_df = pd.read_pickle(folder_path + 'clustered_user_df.pkl')
+        with open(folder_path + 'users_categories_encoder.pkl', 'rb') as f:
+            self.user_category_encoder = pickle.load(f)
+
+        # all columns except 'user_id' and 'cluster' are the encoded categories
+        features = self.clustered_user_df.drop(columns=['user_id', 'cluster']).values
+        self.index = JaccardIndex(features, self.clustered_user_df['cluster'].values)
+
+    # Modification times of the files the assigner was built from
+    @staticmethod
+    def files_version(folder_path):
+        return (os.path.getmtime(folder_path + 'clustered_user_df.pkl'),
+                os.path.getmtime(folder_path + 'users_categories_encoder.pkl'))
+
+    def assign(self, categories_list):
+        encoded = self.user_category_encoder.transform(categories_list)
+        return [int(cluster) for cluster in self.index.nearest_labels(encoded)]
+
+# Accept a single category list or a list of category lists
+def as_category_lists(categories):
+    if not isinstance(categories, list) or not all(isinstance(i, list) for i in categories):
+        categories = [categories]
+    return categories
+
+# Loaded once at startup
+cluster_assigner = ClusterAssigner()
+_reload_lock = threading.Lock()
+
+# Resolved clusters keyed by the canonical (sorted, de-duplicated) category set
+cluster_cache = LRUCache(maxsize=1024)
+
+# Current assigner; reloaded (and the cache dropped) when the cluster files change on disk
+def get_cluster_assigner():
+    global cluster_assigner
+    if ClusterAssigner.files_version(cluster_assigner.folder_path) != cluster_assigner.version:
+        with _reload_lock:
+            if ClusterAssigner.files_version(cluster_assigner.folder_path) != cluster_assigner.version:
+                cluster_assigner = ClusterAssigner(cluster_assigner.folder_path)
+                cluster_cache.clear()
+    return cluster_assigner
+
+def category_key(categories):
+    return tuple(sorted(set(categories)))
+
+def find_cluster_ids(categories_list):
+    assigner = get_cluster_assigner()
+    keys = [category_key(categories) for categories in categories_list]
+    clusters = [cluster_cache.get(key) for key in keys]
+
+    # resolve all misses in one batch
+    missing = list(dict.fromkeys(key for key, cluster in zip(keys, clusters) if cluster is None))
+    if missing:
+        resolved = dict(zip(missing, assigner.assign([list(key) for key in missing])))
+        for key, cluster in resolved.items():
+            cluster_cache.set(key, cluster)
+        clusters = [resolved[key] if cluster is None else cluster for key, cluster in zip(keys, clusters)]
+    return clusters
+
+def cluster_cache_stats():
+    return cluster_cache.stats()
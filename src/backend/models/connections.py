@@ -0,0 +1,113 @@
+import os
+import pathlib
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# Serving databases are rebuilt offline and never written by the backend, so they are opened
+# read-only and, by default, immutable (no locking or change detection). Restart the backend
+# after replacing a database or running the index migration.
+Sqlite_immutable = True
+Sqlite_mmap_size = 256 * 1024 * 1024
+Sqlite_cache_size_kib = 64 * 1024
+# Idle connections kept per database
+Sqlite_pool_size = 8
+# Longest id list sent as an IN (?, ...) list; longer ones go through a temp table (well under SQLite's variable limit)
+Sqlite_in_list_max = 500
+
+def connect_read_only(db_path, immutable=None):
+    immutable = Sqlite_immutable if immutable is None else immutable
+    uri = pathlib.Path(os.path.abspath(db_path)).as_uri() + "?mode=ro" + ("&immutable=1" if immutable else "")
+    # Connections move between request threads through the pool, one thread at a time
+    conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+    conn.execute(f"PRAGMA mmap_size = {Sqlite_mmap_size}")
+    conn.execute(f"PRAGMA cache_size = -{Sqlite_cache_size_kib}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    return conn
+
+class ConnectionPool:
+    # Reuses open connections (and their page cache) across requests instead of connecting per call.
+    # The Flask server runs each request on a new thread, so connections are checked out and back in
+    # rather than pinned to a thread.
+    def __init__(self, connect=connect_read_only, size=Sqlite_pool_size):
+        self.connect = connect
+        self.size = size
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _queue(self, db_path):
+        key = os.path.abspath(db_path)
+        with self._lock:
+            if key not in self._idle:
+                self._idle[key] = queue.LifoQueue()
+            return self._idle[key]
+
+    @contextmanager
+    def connection(self, db_path):
+        idle = self._queue(db_path)
+        try:
+            # most recently used first, its cache is the warmest
+            conn = idle.get_nowait()
+        except queue.Empty:
+            conn = self.connect(db_path)
+        try:
+            yield conn
+        except sqlite3.DatabaseError:
+            # do not hand a connection in an unknown state to the next request
+            conn.close()
+            raise
+        except BaseException:
+            # any other error left the connection usable
+            self._release(idle, conn)
+            raise
+        else:
+            self._release(idle, conn)
+
+    def _release(self, idle, conn):
+        if idle.qsize() < self.size:
+            idle.put(conn)
+        else:
+            conn.close()
+
+    def close_all(self):
+        with self._lock:
+            idle_queues = list(self._idle.values())
+        for idle in idle_queues:
+            while True:
+                try:
+                    idle.get_nowait().close()
+                except queue.Empty:
+                    break
+
+# Shared by every request
+Sqlite_pool = ConnectionPool()
+
+def pooled_connection(db_path):
+    return Sqlite_pool.connection(db_path)
+
+# Replace the connection's temp lookup table with ids (temp tables work on read-only connections)
+def load_lookup_ids(conn, ids):
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS lookup_ids (id TEXT PRIMARY KEY)")
+    conn.execute("DELETE FROM temp.lookup_ids")
+    conn.executemany("INSERT OR IGNORE INTO temp.lookup_ids VALUES (?)", ((key,) for key in ids))
+    conn.commit()
+
+class IdFilter:
+    # WHERE condition selecting rows whose column is one of ids, for one bulk lookup.
+    # Short lists are bound as an IN list; long ones are loaded once per connection into a temp table
+    # that every query of the lookup joins against, so no statement carries thousands of variables.
+    def __init__(self, ids):
+        self.ids = list(dict.fromkeys(ids))
+        self._loaded = set()
+
+    def where(self, conn, column):
+        if len(self.ids) <= Sqlite_in_list_max:
+            return f"{column} IN ({','.join(['?' for _ in self.ids])})", self.ids
+        if id(conn) not in self._loaded:
+            load_lookup_ids(conn, self.ids)
+            self._loaded.add(id(conn))
+        return f"{column} IN (SELECT id FROM temp.lookup_ids)", []
+
+def has_table(conn, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
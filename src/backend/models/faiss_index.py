@@ -0,0 +1,92 @@
+import os
+import time
+import numpy as np
+import faiss
+
+# Index types the DSSM retrieval stage can serve from.
+# The flat index is exact; the others trade some recall for speed as the catalog grows.
+Faiss_index_types = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+
+def faiss_index_path(folder_path, index_type="flat"):
+    # The flat index keeps the file name written by the DSSM index notebook
+    if index_type == "flat":
+        return os.path.join(folder_path, "faiss_index.bin")
+    return os.path.join(folder_path, f"faiss_index_{index_type}.bin")
+
+def faiss_index_description(index_type, num_vectors, nlist=None, m=8, nbits=8, hnsw_m=32):
+    if index_type not in Faiss_index_types:
+        raise ValueError(f"Unknown Faiss index type: {index_type}")
+    # Rule of thumb: about 4 * sqrt(N) inverted lists
+    nlist = nlist or max(1, int(4 * np.sqrt(num_vectors)))
+    return {
+        "flat": "Flat",
+        "ivf_flat": f"IVF{nlist},Flat",
+        "ivf_pq": f"IVF{nlist},PQ{m}x{nbits}",
+        "hnsw": f"HNSW{hnsw_m},Flat",
+    }[index_type]
+
+# Inner-product index over L2-normalized embeddings (cosine similarity), like the flat index
+def build_faiss_index(embeddings, index_type="flat", nlist=None, m=8, nbits=8, hnsw_m=32, ef_construction=200):
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    description = faiss_index_description(index_type, len(embeddings), nlist, m, nbits, hnsw_m)
+    index = faiss.index_factory(embeddings.shape[1], description, faiss.METRIC_INNER_PRODUCT)
+    if index_type == "hnsw":
+        index.hnsw.efConstruction = ef_construction
+    if not index.is_trained:
+        index.train(embeddings)
+    index.add(embeddings)
+    return index
+
+# Stored vectors of an index that keeps them uncompressed (the flat index)
+def index_embeddings(index):
+    return index.reconstruct_n(0, index.ntotal)
+
+# nprobe applies to IVF indexes, efSearch to HNSW; other parameters are left alone
+def set_search_parameters(index, nprobe=None, ef_search=None):
+    parameters = faiss.ParameterSpace()
+    if nprobe is not None and "nprobe" in index_parameter_names(index):
+        parameters.set_index_parameter(index, "nprobe", nprobe)
+    if ef_search is not None and "efSearch" in index_parameter_names(index):
+        parameters.set_index_parameter(index, "efSearch", ef_search)
+    return index
+
+def index_parameter_names(index):
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexIVF):
+        return ("nprobe",)
+    if isinstance(index, faiss.IndexHNSW):
+        return ("efSearch",)
+    return ()
+
+def load_faiss_index(folder_path, index_type="flat", nprobe=None, ef_search=None):
+    index = faiss.read_index(faiss_index_path(folder_path, index_type))
+    return set_search_parameters(index, nprobe, ef_search)
+
+# Fraction of the exact top-k that the candidate index also returns, averaged over the queries.
+# Faiss pads results with -1 when the index holds fewer than k vectors, so each row is scored
+# against its valid exact neighbours only.
+def recall_at_k(exact_indices, candidate_indices):
+    recalls = []
+    for exact, candidate in zip(exact_indices, candidate_indices):
+        exact = exact[exact >= 0]
+        if len(exact):
+            recalls.append(len(np.intersect1d(exact, candidate[candidate >= 0], assume_unique=True)) / len(exact))
+    return float(np.mean(recalls)) if recalls else 0.0
+
+def queries_per_second(index, queries, k, batch_size=1):
+    start = time.perf_counter()
+    for i in range(0, len(queries), batch_size):
+        index.search(queries[i:i + batch_size], k)
+    return len(queries) / (time.perf_counter() - start)
+
+# recall@k against the flat index and QPS (one query per search, as served, and the whole batch at once)
+def benchmark_faiss_index(flat_index, index, queries, k, exact_indices=None):
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    if exact_indices is None:
+        _, exact_indices = flat_index.search(queries, k)
+    _, candidate_indices = index.search(queries, k)
+    return {
+        "recall": recall_at_k(exact_indices, candidate_indices),
+        "qps": queries_per_second(index, queries, k),
+        "batch_qps": queries_per_second(index, queries, k, batch_size=len(queries)),
+    }
@@ -0,0 +1,135 @@
+import os
+import numpy as np
+
+# Bidirectional id <-> index dictionary: a NumPy array of ids (index -> id)
+# plus a hash lookup (id -> index) built once on first use.
+# The id array is persisted as .npy and memory-mapped, so serving and evaluation share one copy.
+class IdMapping:
+    def __init__(self, ids):
+        self.ids = ids
+        self._index = None
+
+    @classmethod
+    def from_mapping(cls, mapping):
+        # mapping is {id: idx}, as stored in the business_mapping / user_mapping / cluster_mapping tables.
+        # Unused indices (gaps in idx) hold an empty id and are left out of the lookup.
+        ids = [''] * (max(mapping.values()) + 1 if mapping else 0)
+        for key, idx in mapping.items():
+            ids[idx] = key
+        return cls(np.array(ids, dtype=str))
+
+    @classmethod
+    def from_ids(cls, ids):
+        return cls(np.asarray(ids))
+
+    @classmethod
+    def from_label_encoder(cls, encoder):
+        # A fitted sklearn LabelEncoder maps classes_[i] to i
+        return cls(np.asarray(encoder.classes_.tolist()))
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        return cls(np.load(path, mmap_mode=mmap_mode))
+
+    def save(self, path):
+        # fixed-width unicode, so the file can be memory-mapped (object arrays cannot)
+        np.save(path, np.asarray(self.ids, dtype=str))
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = {key: idx for idx, key in enumerate(self.ids.tolist()) if key != ''}
+        return self._index
+
+    # Dict-style access, so an IdMapping can be passed wherever a {id: idx} mapping was used
+    def __getitem__(self, key):
+        return self.index[key]
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids.tolist())
+
+    def get(self, key, default=None):
+        return self.index.get(key, default)
+
+    def keys(self):
+        return self.index.keys()
+
+    def values(self):
+        return self.index.values()
+
+    def items(self):
+        return self.index.items()
+
+    def id_of(self, idx):
+        return str(self.ids[idx])
+
+    # Batch id -> index, unknown ids become `default`
+    def encode(self, keys, default=-1):
+        index = self.index
+        return np.array([index.get(key, default) for key in keys], dtype=np.int64)
+
+    # Batch index -> id
+    def decode(self, indices):
+        return self.ids[np.asarray(indices, dtype=np.int64)].tolist()
+
+    # LabelEncoder interface, so an IdMapping can replace the pickled sklearn encoders at serving time
+    @property
+    def classes_(self):
+        return self.ids
+
+    def transform(self, keys):
+        encoded = self.encode(keys)
+        if (encoded < 0).any():
+            unseen = [key for key, idx in zip(keys, encoded) if idx < 0]
+            raise ValueError(f"y contains previously unseen labels: {unseen}")
+        return encoded
+
+    def inverse_transform(self, indices):
+        return self.ids[np.asarray(indices, dtype=np.int64)]
+
+# Load a persisted mapping next to its database, rebuilding it when the database is newer.
+# The query returns (id, idx) rows, or a single id column that is numbered in order.
+# Mappings whose idx values are not 0..n-1, or that cannot be written or memory-mapped, are kept in memory.
+def load_id_mapping(conn, db_path, query, name):
+    cache_path = os.path.splitext(db_path)[0] + '_' + name + '.npy'
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(db_path):
+        try:
+            return IdMapping.load(cache_path)
+        except (OSError, ValueError):
+            # unreadable or not a memory-mappable array, rebuild it
+            pass
+
+    cursor = conn.cursor()
+    cursor.execute(query)
+    rows = cursor.fetchall()
+    if rows and len(rows[0]) == 2:
+        mapping = {str(row[0]): int(row[1]) for row in rows}
+        contiguous = sorted(mapping.values()) == list(range(len(mapping)))
+        id_mapping = IdMapping.from_mapping(mapping)
+    else:
+        contiguous = True
+        id_mapping = IdMapping.from_ids([str(row[0]) for row in rows])
+    if not contiguous:
+        return id_mapping
+
+    try:
+        id_mapping.save(cache_path)
+        return IdMapping.load(cache_path)
+    except (OSError, ValueError):
+        # read-only data folder or an array that cannot be memory-mapped, keep the in-memory copy
+        return id_mapping
+
+# Wrap a plain {id: idx} dict or a fitted LabelEncoder. This builds a new mapping on every call,
+# so loaders convert their encoders and mappings once and pass the IdMapping around.
+def as_id_mapping(mapping):
+    if isinstance(mapping, IdMapping):
+        return mapping
+    if hasattr(mapping, 'classes_'):
+        return IdMapping.from_label_encoder(mapping)
+    return IdMapping.from_mapping(mapping)
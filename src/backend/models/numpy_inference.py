@@ -0,0 +1,146 @@
+import numpy as np
+
+# Pure-NumPy forward passes for the serving models, so requests do not go through TensorFlow.
+# Weights are exported once from the .keras files into .npz archives (see offline_jobs.py).
+
+Activations = {
+    "linear": lambda x: x,
+    "relu": lambda x: np.maximum(x, 0),
+    "sigmoid": lambda x: 1 / (1 + np.exp(-x)),
+}
+
+def dense_layers_of(model):
+    return [layer for layer in model.layers if layer.__class__.__name__ == "Dense"]
+
+def embedding_layers_of(model):
+    return [layer for layer in model.layers if layer.__class__.__name__ == "Embedding"]
+
+def dense_weights(layer):
+    kernel, bias = layer.get_weights()
+    return kernel.astype(np.float32), bias.astype(np.float32), layer.get_config()["activation"]
+
+# Apply a chain of (kernel, bias, activation) layers
+def dense_forward(x, layers):
+    for kernel, bias, activation in layers:
+        x = Activations[activation](x @ kernel + bias)
+    return x
+
+def save_dense_layers(arrays, prefix, layers):
+    for i, (kernel, bias, activation) in enumerate(layers):
+        arrays[f"{prefix}{i}_kernel"] = kernel
+        arrays[f"{prefix}{i}_bias"] = bias
+        arrays[f"{prefix}{i}_activation"] = np.array(activation)
+
+def load_dense_layers(weights, prefix):
+    layers = []
+    while f"{prefix}{len(layers)}_kernel" in weights:
+        i = len(layers)
+        layers.append((weights[f"{prefix}{i}_kernel"], weights[f"{prefix}{i}_bias"], str(weights[f"{prefix}{i}_activation"])))
+    return layers
+
+def check_exported_parameters(model, arrays):
+    exported = sum(array.size for name, array in arrays.items() if not name.endswith("_activation"))
+    if exported != model.count_params():
+        raise ValueError(f"{model.name}: exported {exported} of {model.count_params()} parameters, the architecture is not the one this engine mirrors")
+
+class NumpyUserTower:
+    # DSSM user tower: Embedding(user_id) -> Flatten -> Concatenate with the continuous features -> Dense 64 relu -> Dense 32 relu -> Dense 16
+    def __init__(self, embedding, layers):
+        self.embedding = embedding
+        self.layers = layers
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as weights:
+            return cls(weights["embedding"], load_dense_layers(weights, "dense"))
+
+    @staticmethod
+    def export(user_model, path):
+        (embedding,) = embedding_layers_of(user_model)
+        arrays = {"embedding": embedding.get_weights()[0].astype(np.float32)}
+        save_dense_layers(arrays, "dense", [dense_weights(layer) for layer in dense_layers_of(user_model)])
+        check_exported_parameters(user_model, arrays)
+        np.savez(path, **arrays)
+
+    def embed(self, user_ids_encoded, user_continuous_features):
+        user_ids_encoded = np.asarray(user_ids_encoded, dtype=np.int64).reshape(-1)
+        x = np.concatenate([self.embedding[user_ids_encoded], np.asarray(user_continuous_features, dtype=np.float32)], axis=1)
+        return dense_forward(x, self.layers)
+
+    # Same call as the Keras model, so it can stand in for user_model
+    def predict(self, inputs, verbose=0, batch_size=None):
+        user_ids_encoded, user_continuous_features = inputs
+        return self.embed(user_ids_encoded, user_continuous_features)
+
+class NumpyDeepFM:
+    # DeepFM as built by build_deepfm_mixed_model (Models_Deep_FM/DeepFM.ipynb):
+    #   linear_part: Dense(1) over the continuous features
+    #   deep part:   Concatenate(continuous, user_id embedding, business_id embedding) -> deep_dense_i relu -> deep_output Dense(1)
+    #   output:      linear_part + deep_output (dropout is the identity at inference)
+    # The trained graph has no FM second-order term, so none is computed here.
+    def __init__(self, linear, user_embedding, business_embedding, deep_layers, output_layer):
+        self.linear = linear
+        self.user_embedding = user_embedding
+        self.business_embedding = business_embedding
+        self.deep_layers = deep_layers
+        self.output_layer = output_layer
+
+        # First deep layer split by input block, so constant blocks are multiplied once
+        kernel, bias, activation = deep_layers[0]
+        num_continuous = linear[0].shape[0]
+        embed_dim = user_embedding.shape[1]
+        self.first_continuous = kernel[:num_continuous]
+        self.first_user = kernel[num_continuous:num_continuous + embed_dim]
+        self.first_business = kernel[num_continuous + embed_dim:]
+        # business embedding already projected through the first deep layer
+        self.business_projection = business_embedding @ self.first_business
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as weights:
+            deep_layers = load_dense_layers(weights, "deep")
+            return cls(load_dense_layers(weights, "linear")[0], weights["user_embedding"], weights["business_embedding"], deep_layers[:-1], deep_layers[-1])
+
+    @staticmethod
+    def export(DeepFM_model, path):
+        deep_layers = [layer for layer in dense_layers_of(DeepFM_model) if layer.name.startswith("deep_dense_")]
+        deep_layers.sort(key=lambda layer: int(layer.name.rsplit("_", 1)[1]))
+        arrays = {
+            "user_embedding": DeepFM_model.get_layer("user_id_encoded_emb").get_weights()[0].astype(np.float32),
+            "business_embedding": DeepFM_model.get_layer("business_id_encoded_emb").get_weights()[0].astype(np.float32),
+        }
+        save_dense_layers(arrays, "linear", [dense_weights(DeepFM_model.get_layer("linear_part"))])
+        save_dense_layers(arrays, "deep", [dense_weights(layer) for layer in deep_layers] + [dense_weights(DeepFM_model.get_layer("deep_output"))])
+        check_exported_parameters(DeepFM_model, arrays)
+        np.savez(path, **arrays)
+
+    def _output(self, continuous_features, first_layer):
+        kernel, bias, activation = self.deep_layers[0]
+        deep = dense_forward(Activations[activation](first_layer + bias), self.deep_layers[1:] + [self.output_layer])
+        linear_kernel, linear_bias, _ = self.linear
+        return continuous_features @ linear_kernel + linear_bias + deep
+
+    # Same call as the Keras model: [continuous features, user ids (n, 1), business ids (n, 1)] -> (n, 1)
+    def predict(self, inputs, verbose=0, batch_size=None):
+        continuous_features, user_ids, business_ids = inputs
+        continuous_features = np.asarray(continuous_features, dtype=np.float32)
+        user_ids = np.asarray(user_ids, dtype=np.int64).reshape(-1)
+        business_ids = np.asarray(business_ids, dtype=np.int64).reshape(-1)
+        first_layer = continuous_features @ self.first_continuous + self.user_embedding[user_ids] @ self.first_user + self.business_projection[business_ids]
+        return self._output(continuous_features, first_layer)
+
+    # One user against many businesses: the user blocks of the first layer are computed once
+    def score_user(self, user_continuous_features, user_id, business_continuous_features, business_ids):
+        user_continuous_features = np.asarray(user_continuous_features, dtype=np.float32).reshape(-1)
+        business_continuous_features = np.asarray(business_continuous_features, dtype=np.float32)
+        business_ids = np.asarray(business_ids, dtype=np.int64).reshape(-1)
+        num_user_features = len(user_continuous_features)
+
+        user_part = user_continuous_features @ self.first_continuous[:num_user_features] + self.user_embedding[user_id] @ self.first_user
+        first_layer = business_continuous_features @ self.first_continuous[num_user_features:] + self.business_projection[business_ids] + user_part
+        continuous_features = np.concatenate([np.broadcast_to(user_continuous_features, (len(business_ids), num_user_features)), business_continuous_features], axis=1)
+        return self._output(continuous_features, first_layer)
+
+# Largest absolute difference between two models' outputs on the same inputs
+def max_abs_difference(model, other, inputs):
+    return float(np.max(np.abs(np.asarray(model.predict(inputs, verbose=0)) - np.asarray(other.predict(inputs, verbose=0)))))
@@ -1,8 +1,11 @@
 import numpy as np
 import pandas as pd
-from sklearn.neighbors import NearestNeighbors
+from scipy.sparse import csr_matrix
 import pickle
 import sqlite3
+from .id_mapping import IdMapping, as_id_mapping, load_id_mapping
+from . import cluster_index
+from .cluster_index import as_category_lists
 
 # Database connection function
 def get_db_connection(db_path):
@@ -20,53 +23,115 @@ def get_cluster_businesses(conn, msg, cluster):
     cursor.execute(msg, (cluster,))
     return cursor.fetchall()
 
-# Retrieval Functions
-def get_cluster_mapping(conn):
+# Load pickled (indices, data) similarity vectors into a CSR matrix (float32 values, int32 indices)
+# Each row is sorted by descending score so that its first k entries are its top-k neighbours
+def load_similarity_matrix(conn, query, row_mapping, num_cols):
     cursor = conn.cursor()
-    cursor.execute('SELECT cluster_id, cluster_idx FROM cluster_mapping')
-    return {str(row[0]): row[1] for row in cursor.fetchall()}  # Ensure cluster_id is string
+    cursor.execute(query)
 
-def find_nearest_neighbor(encoded_try_list: np.ndarray, clustered_user_df: pd.DataFrame):
-    # Ensure the clustered_user_df has a 'user_id' column and encoded category columns.
-    if 'user_id' not in clustered_user_df.columns:
-        raise ValueError("clustered_user_df must include a 'user_id' column.")
-
-    # Select the encoded features from clustered_user_df; assume all columns except 'user_id'
-    features = clustered_user_df.drop(columns=['user_id', 'cluster']).values
-
-    # Create the NearestNeighbors model using Jaccard metric
-    nn_model = NearestNeighbors(n_neighbors=1, metric='jaccard')
-    nn_model.fit(features)
-
-    # Query the model to get nearest neighbor index and distance
-    distances, indices = nn_model.kneighbors(encoded_try_list)
-
-    # Create a list to hold results
-    results = []
-    for idx, (dist, ind) in enumerate(zip(distances, indices)):
-        # Get the corresponding user_id from clustered_user_df using the index
-        nearest_cluster_id = clustered_user_df.iloc[ind[0]]['cluster']
-        results.append({
-            'input_index': int(idx),
-            'nearest_cluster_id': int(nearest_cluster_id),
-            # 'distance': dist[0]
-        })
-    return results
+    indptr = [0]
+    indices = []
+    data = []
+    row_ids = []
+    for row_id, similarity_vector in cursor:
+        row_id = str(row_id)
+        if row_id not in row_mapping:
+            continue
+        row_indices, row_data = pickle.loads(similarity_vector)
+        order = np.argsort(-np.asarray(row_data), kind='stable')
+        indices.append(np.asarray(row_indices, dtype=np.int32)[order])
+        data.append(np.asarray(row_data, dtype=np.float32)[order])
+        indptr.append(indptr[-1] + len(order))
+        row_ids.append(row_mapping[row_id])
 
-def find_cluster_id(categories: list):
-    Cluster_folder_path = "../../data/processed_data/cluster_data/"
+    # rows are read in table order, so place them at their mapped index
+    num_rows = len(row_mapping)
+    row_nnz = np.zeros(num_rows, dtype=np.int32)
+    row_nnz[row_ids] = np.diff(indptr)
+    full_indptr = np.zeros(num_rows + 1, dtype=np.int32)
+    np.cumsum(row_nnz, out=full_indptr[1:])
+
+    order = np.argsort(row_ids, kind='stable')
+    all_indices = np.concatenate([indices[i] for i in order]) if order.size else np.empty(0, dtype=np.int32)
+    all_data = np.concatenate([data[i] for i in order]) if order.size else np.empty(0, dtype=np.float32)
+    return csr_matrix((all_data, all_indices, full_indptr), shape=(num_rows, num_cols))
+
+# Load (row_id, col_id, value) rows into a CSR matrix, keeping the query order within each row
+# If no row_mapping is given, rows are numbered in order of first appearance
+def load_interaction_matrix(conn, query, col_mapping, row_mapping=None):
+    df = pd.read_sql_query(query, conn)
+    df.columns = ['row_id', 'col_id', 'value']
+    col_mapping = as_id_mapping(col_mapping)
+    col_idx = col_mapping.encode(df['col_id'].astype(str).values)
+
+    if row_mapping is None:
+        codes, uniques = pd.factorize(df['row_id'])
+        row_mapping = IdMapping.from_ids(uniques.astype(str))
+        row_idx = codes.astype(np.int64)
+    else:
+        row_mapping = as_id_mapping(row_mapping)
+        row_idx = row_mapping.encode(df['row_id'].astype(str).values)
+
+    keep = (row_idx >= 0) & (col_idx >= 0)
+    order = np.argsort(row_idx[keep], kind='stable')
+    row_idx = row_idx[keep][order]
+    row_nnz = np.bincount(row_idx, minlength=len(row_mapping))
+    indptr = np.zeros(len(row_mapping) + 1, dtype=np.int32)
+    np.cumsum(row_nnz, out=indptr[1:])
 
-    clustered_user_df = pd.read_pickle(Cluster_folder_path + 'clustered_user_df.pkl')
+    indices = col_idx[keep][order].astype(np.int32)
+    data = np.nan_to_num(df['value'].values[keep][order].astype(np.float32))
+    matrix = csr_matrix((data, indices, indptr), shape=(len(row_mapping), len(col_mapping)))
+    return matrix, row_mapping
 
-    if not isinstance(categories, list) or not all(isinstance(i, list) for i in categories):
-        categories = [categories]
-    categories = np.array(categories)
+# Sparse vector-matrix product w @ matrix[rows], keeping only the first k entries of each row
+# Returns the touched columns, their scores and the position they were first met (for stable ordering)
+def sparse_row_product(matrix, rows, weights=None, k=None):
+    rows = np.asarray(rows, dtype=np.int64)
+    starts = matrix.indptr[rows].astype(np.int64)
+    lengths = matrix.indptr[rows + 1] - starts
+    if k is not None:
+        lengths = np.minimum(lengths, k)
+    if weights is None:
+        weights = np.ones(len(rows))
 
-    with open(Cluster_folder_path + 'users_categories_encoder.pkl', 'rb') as f:
-        user_category_encoder = pickle.load(f)
-        f.close()
+    total = int(lengths.sum())
+    if total == 0:
+        return np.empty(0, dtype=np.int32), np.empty(0), np.empty(0, dtype=np.int64)
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(total)
+    values = matrix.data[offsets].astype(np.float64) * np.repeat(np.asarray(weights, dtype=np.float64), lengths)
 
-    encoded_try_list = user_category_encoder.transform(categories)
+    columns, first_seen, inverse = np.unique(matrix.indices[offsets], return_index=True, return_inverse=True)
+    scores = np.bincount(inverse, weights=values, minlength=len(columns))
+    return columns, scores, first_seen
+
+# Positions of the k largest scores in descending order (ties keep the order given by tie_breaker)
+def top_k_scores(scores, k, tie_breaker=None):
+    if k <= 0 or len(scores) == 0:
+        return np.empty(0, dtype=np.int64)
+    if tie_breaker is None:
+        tie_breaker = np.arange(len(scores))
+    if k < len(scores):
+        # argpartition finds the k-th score; keep everything tied with it so the tie-break stays exact
+        kth_score = scores[np.argpartition(-scores, k - 1)[k - 1]]
+        candidates = np.flatnonzero(scores >= kth_score)
+    else:
+        candidates = np.arange(len(scores))
+    order = np.lexsort((tie_breaker[candidates], -scores[candidates]))
+    return candidates[order][:k]
+
+# Retrieval Functions
+def get_cluster_mapping(conn, db_path=None):
+    if db_path is not None:
+        # cluster_id is stored as a string in the persisted IdMapping
+        return load_id_mapping(conn, db_path, 'SELECT cluster_id, cluster_idx FROM cluster_mapping', 'cluster_mapping')
+    cursor = conn.cursor()
+    cursor.execute('SELECT cluster_id, cluster_idx FROM cluster_mapping')
+    return {str(row[0]): row[1] for row in cursor.fetchall()}  # Ensure cluster_id is string
+
+def find_cluster_id(categories: list):
+    return find_cluster_ids(as_category_lists(categories))[0]
 
-    results = find_nearest_neighbor(encoded_try_list,clustered_user_df)
-    return results[0]['nearest_cluster_id']
+# Batch version: one cluster id per category list (memoized, see cluster_index.cluster_cache)
+def find_cluster_ids(categories_list: list):
+    return cluster_index.find_cluster_ids(categories_list)
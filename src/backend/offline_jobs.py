@@ -0,0 +1,273 @@
+"""
+Offline jobs that precompute serving artifacts for the backend.
+Run them from src/backend (the data paths are relative to it), e.g.
+
+    pipenv run python offline_jobs.py cluster-recommendations
+"""
+
+import argparse
+
+def cluster_recommendations(args):
+    from models.Cluster import build_cluster_recommendations, save_cluster_recommendations, Cluster_recommendations_path
+
+    recommendations = build_cluster_recommendations(k=args.k)
+    save_cluster_recommendations(recommendations)
+    print(f"Saved recommendations for {len(recommendations['clusters'])} clusters to {Cluster_recommendations_path}.")
+
+def dssm_user_embeddings(args):
+    from models.DSSM import export_user_embeddings, DSSM_user_embeddings_path
+
+    count = export_user_embeddings(batch_size=args.batch_size)
+    print(f"Saved {count} user embeddings to {DSSM_user_embeddings_path}.")
+
+def dssm_user_tower(args):
+    import os
+    import sys
+    from models.DSSM import export_user_tower, check_user_tower, DSSM_user_tower_path
+
+    # --check-only compares the current export without rewriting it; either way the job exits non-zero above the tolerance
+    difference, num_users = (check_user_tower if args.check_only else export_user_tower)(num_users=args.users)
+    print(f"Max |NumPy - Keras| over {num_users} users: {difference:.2e}")
+    # Serving picks the export up automatically, so a mismatching one is removed
+    if difference > args.tolerance:
+        os.remove(DSSM_user_tower_path)
+        sys.exit(f"Parity check failed (tolerance {args.tolerance}), removed {DSSM_user_tower_path}.")
+    if args.check_only:
+        print(f"Parity check passed for {DSSM_user_tower_path}.")
+        return
+    print(f"Saved the user tower weights to {DSSM_user_tower_path}.")
+
+def deepfm_engine(args):
+    import os
+    import sys
+    import time
+    import numpy as np
+    from models.DeepFM import export_DeepFM_engine, check_DeepFM_engine, DeepFM_random_inputs, DeepFM_weights_path, DeepFM_user_scaler
+
+    keras_model, engine, difference = (check_DeepFM_engine if args.check_only else export_DeepFM_engine)(num_samples=max(args.candidates))
+    print(f"Max |NumPy - Keras| over {max(args.candidates)} candidates: {difference:.2e}")
+    # Serving picks the export up automatically, so a mismatching one is removed
+    if difference > args.tolerance:
+        os.remove(DeepFM_weights_path)
+        sys.exit(f"Parity check failed (tolerance {args.tolerance}), removed {DeepFM_weights_path}.")
+    if args.check_only:
+        print(f"Parity check passed for {DeepFM_weights_path}.")
+        return
+    print(f"Saved the DeepFM weights to {DeepFM_weights_path}.")
+
+    def median_ms(score):
+        timings = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            score()
+            timings.append((time.perf_counter() - start) * 1000)
+        return float(np.median(timings))
+
+    print(f"{'candidates':>10} {'keras ms':>10} {'numpy ms':>10} {'numpy user ms':>14}")
+    for num_candidates in args.candidates:
+        features, user_ids, business_ids = DeepFM_random_inputs(engine, num_candidates, seed=num_candidates)
+        num_user_features = DeepFM_user_scaler.n_features_in_
+        keras_ms = median_ms(lambda: keras_model.predict([features, user_ids, business_ids], verbose=0))
+        numpy_ms = median_ms(lambda: engine.predict([features, user_ids, business_ids]))
+        user_ms = median_ms(lambda: engine.score_user(features[0, :num_user_features], user_ids[0, 0], features[:, num_user_features:], business_ids))
+        print(f"{num_candidates:>10} {keras_ms:>10.2f} {numpy_ms:>10.2f} {user_ms:>14.2f}")
+
+def itemcf_parity(args):
+    import sys
+    from models.ItemCF import check_vectorized_ranking
+
+    num_users, mismatches = check_vectorized_ranking(num_users=args.users, k=args.k, tolerance=args.tolerance)
+    print(f"Vectorized vs loop ItemCF ranking over {num_users} users (k={args.k}): {len(mismatches)} differ")
+    if mismatches:
+        sys.exit(f"Parity check failed (tolerance {args.tolerance}), e.g. user {mismatches[0]}.")
+
+def deepfm_business_features(args):
+    from models.DeepFM import build_business_features, save_business_features, DeepFM_business_features_path
+
+    business_features = build_business_features()
+    save_business_features(business_features)
+    print(f"Saved features for {len(business_features)} businesses to {DeepFM_business_features_path}.")
+
+def prerank_eval(args):
+    import sqlite3
+    import sys
+    import pandas as pd
+    from pipeline import Pipeline, merge_config
+    from api import DeepFM_pipeline
+    from models.DeepFM import DeepFM_user_id_encoder
+    from retrieve_info import db_path_review, retrieve_user_info
+    sys.path.append('..')
+    from utilities import check_retrieval_recommendations, compute_evaluation_metric
+
+    # Reviewed businesses of a sample of users known to DeepFM are the ground truth
+    with sqlite3.connect(db_path_review) as conn:
+        user_ids = [row[0] for row in conn.execute("SELECT DISTINCT user_id FROM review_data ORDER BY RANDOM() LIMIT ?", (args.users * 10,))]
+        user_ids = [user_id for user_id in user_ids if user_id in DeepFM_user_id_encoder][:args.users]
+        test_data = pd.read_sql(f"SELECT user_id, business_id, stars AS stars_review FROM review_data WHERE user_id IN ({','.join(['?' for _ in user_ids])})", conn, params=user_ids)
+    test_data_grouped = test_data.groupby('user_id')['business_id'].apply(list).reset_index()
+
+    # Same sources and ranker, without and with the pre-rank cut (no display post-processing)
+    pipelines = {
+        "full": Pipeline(DeepFM_pipeline.sources, DeepFM_pipeline.ranker, merge_config(DeepFM_pipeline.config, {"prerank": {"enabled": False}}), popularity=DeepFM_pipeline.popularity),
+        f"prerank@{args.k}": Pipeline(DeepFM_pipeline.sources, DeepFM_pipeline.ranker, merge_config(DeepFM_pipeline.config, {"prerank": {"enabled": True, "k": args.k}}), popularity=DeepFM_pipeline.popularity),
+    }
+    recommendations = {name: {} for name in pipelines}
+    rank_ms = {name: [] for name in pipelines}
+    for user_id in user_ids:
+        context = {"users": retrieve_user_info(user_id)}
+        for name, pipeline in pipelines.items():
+            result = pipeline.run(user_id, context)
+            business_ids = [business_id for business_id, _ in result["recommendations"]]
+            recommendations[name][user_id] = (business_ids, [score for _, score in result["recommendations"]])
+            rank_ms[name] += [stage["ms"] for stage in result["stages"] if stage["stage"] == "rank"]
+
+    for name in pipelines:
+        evaluation_metric, confusion, background_stats = compute_evaluation_metric(*check_retrieval_recommendations(recommendations[name], test_data, test_data_grouped, pos=args.pos))
+        print(f"== {name} (mean rank stage {sum(rank_ms[name]) / max(len(rank_ms[name]), 1):.1f} ms)")
+        print(evaluation_metric.to_string(index=False))
+        print(confusion.to_string(index=False))
+
+    # Share of the full ranking's top k that survives the cut
+    full, cut = recommendations["full"], recommendations[f"prerank@{args.k}"]
+    overlaps = [len(set(full[user_id][0]) & set(cut[user_id][0])) / len(full[user_id][0]) for user_id in user_ids if full[user_id][0]]
+    print(f"Top-k overlap with the full ranking: {sum(overlaps) / max(len(overlaps), 1):.4f} over {len(overlaps)} users")
+
+def faiss_index(args):
+    import faiss
+    from models.DSSM import DSSM_folder_path
+    from models.faiss_index import build_faiss_index, index_embeddings, faiss_index_path
+
+    # Variants are built from the vectors stored in the flat index written by the DSSM index notebook
+    embeddings = index_embeddings(faiss.read_index(faiss_index_path(DSSM_folder_path)))
+    for index_type in args.types:
+        index = build_faiss_index(embeddings, index_type, nlist=args.nlist, m=args.m, nbits=args.nbits, hnsw_m=args.hnsw_m, ef_construction=args.ef_construction)
+        path = faiss_index_path(DSSM_folder_path, index_type)
+        faiss.write_index(index, path)
+        print(f"Saved {index_type} index over {index.ntotal} businesses to {path}.")
+
+def faiss_benchmark(args):
+    import os
+    import numpy as np
+    from models.DSSM import DSSM_folder_path, DSSM_user_id_encoder, DSSM_lookup_user_embeddings, DSSM_user_model, DSSM_user_scaler, DSSM_user_continuous_features_scaled, DSSM_user_embeddings
+    from models.faiss_index import load_faiss_index, faiss_index_path, benchmark_faiss_index
+
+    # Queries are the embeddings of a random sample of users
+    rng = np.random.default_rng(args.seed)
+    user_ids = rng.choice(DSSM_user_id_encoder.classes_, size=min(args.queries, len(DSSM_user_id_encoder.classes_)), replace=False)
+    queries = DSSM_lookup_user_embeddings(list(user_ids), DSSM_user_model, DSSM_user_id_encoder, DSSM_user_scaler, DSSM_user_continuous_features_scaled, DSSM_user_embeddings)
+
+    flat_index = load_faiss_index(DSSM_folder_path)
+    _, exact_indices = flat_index.search(queries, args.k)
+
+    print(f"{'index':<10} {'param':<14} {'recall@' + str(args.k):>12} {'qps':>10} {'batch qps':>10}")
+    for index_type in args.types:
+        if not os.path.exists(faiss_index_path(DSSM_folder_path, index_type)):
+            print(f"{index_type:<10} missing, build it with the faiss-index job")
+            continue
+        if index_type in ("ivf_flat", "ivf_pq"):
+            settings = [("nprobe", value, dict(nprobe=value)) for value in args.nprobe]
+        elif index_type == "hnsw":
+            settings = [("efSearch", value, dict(ef_search=value)) for value in args.ef_search]
+        else:
+            settings = [("-", "", {})]
+        for name, value, parameters in settings:
+            index = load_faiss_index(DSSM_folder_path, index_type, **parameters)
+            result = benchmark_faiss_index(flat_index, index, queries, args.k, exact_indices)
+            print(f"{index_type:<10} {f'{name}={value}' if value != '' else name:<14} {result['recall']:>12.4f} {result['qps']:>10.1f} {result['batch_qps']:>10.1f}")
+
+def yelp_indexes(args):
+    from index_migration import migrate
+
+    for report in migrate(dry_run=args.dry_run):
+        print(f"{report['db_path']}:")
+        for name, table, columns in report["created"]:
+            print(f"  {'would create' if args.dry_run else 'created'} {name} ON {table} ({', '.join(columns)})")
+        for name, table, columns in report["existing"]:
+            print(f"  exists {name} ON {table} ({', '.join(columns)})")
+        for name, table, columns in report["conflicts"]:
+            print(f"  CONFLICT {name} ON {table} has ({', '.join(columns)}), drop it and re-run to rebuild")
+        for name, replacement in report["dropped"]:
+            print(f"  {'would drop' if args.dry_run else 'dropped'} {name} (replaced by {replacement})")
+        for table in report["summaries"]:
+            print(f"  {'would rebuild' if args.dry_run else 'rebuilt'} {table}")
+        for query, before in report["before"].items():
+            print(f"  {' '.join(query.split())}")
+            print(f"    before: {'; '.join(before)}")
+            print(f"    after:  {'; '.join(report['after'][query])}")
+    if not args.dry_run:
+        print("Restart the backend: it opens the databases as immutable and does not see schema changes.")
+
+def checkin_stats(args):
+    from retrieve_info import build_checkin_stats, db_path_business, Checkin_stats_table
+
+    count = build_checkin_stats()
+    print(f"Saved check-in histograms of {count} businesses to {Checkin_stats_table} in {db_path_business}.")
+    print("Restart the backend: it opens the databases as immutable and does not see schema changes.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute serving artifacts for the backend.")
+    subparsers = parser.add_subparsers(dest="job", required=True)
+
+    job = subparsers.add_parser("cluster-recommendations", help="ItemCF + UserCF lists for every cluster (/Cluster_recommendations)")
+    job.add_argument("--k", type=int, default=100, help="largest ItemCF k served from the table")
+    job.set_defaults(func=cluster_recommendations)
+
+    job = subparsers.add_parser("dssm-user-embeddings", help="L2-normalized DSSM user embeddings (re-run after every user model release)")
+    job.add_argument("--batch-size", type=int, default=4096, help="users per predict call")
+    job.set_defaults(func=dssm_user_embeddings)
+
+    job = subparsers.add_parser("dssm-user-tower", help="NumPy DSSM user tower weights, checked against the Keras model")
+    job.add_argument("--users", type=int, default=1000, help="users in the parity check")
+    job.add_argument("--tolerance", type=float, default=1e-4, help="largest allowed absolute embedding difference")
+    job.add_argument("--check-only", action="store_true", help="check the current export against Keras without re-exporting")
+    job.set_defaults(func=dssm_user_tower)
+
+    job = subparsers.add_parser("deepfm-engine", help="NumPy DeepFM weights, checked against Keras and benchmarked")
+    job.add_argument("--candidates", type=int, nargs="+", default=[1000, 5000, 10000], help="candidate list sizes to benchmark")
+    job.add_argument("--repeats", type=int, default=20)
+    job.add_argument("--tolerance", type=float, default=1e-4, help="largest allowed absolute score difference")
+    job.add_argument("--check-only", action="store_true", help="check the current export against Keras without re-exporting")
+    job.set_defaults(func=deepfm_engine)
+
+    job = subparsers.add_parser("itemcf-parity", help="vectorized ItemCF ranking checked against the reference loop")
+    job.add_argument("--users", type=int, default=1000, help="users in the parity check")
+    job.add_argument("--k", type=int, default=300)
+    job.add_argument("--tolerance", type=float, default=1e-5, help="largest allowed absolute score difference")
+    job.set_defaults(func=itemcf_parity)
+
+    job = subparsers.add_parser("deepfm-business-features", help="scaled DeepFM business features indexed by encoded business id (re-run after data refreshes)")
+    job.set_defaults(func=deepfm_business_features)
+
+    job = subparsers.add_parser("prerank-eval", help="recall loss of the DeepFM pre-rank cut against ranking every candidate")
+    job.add_argument("--users", type=int, default=200, help="number of sampled users")
+    job.add_argument("--k", type=int, default=800, help="candidates kept by the pre-ranker")
+    job.add_argument("--pos", type=float, default=4, help="stars from which a review counts as positive")
+    job.set_defaults(func=prerank_eval)
+
+    job = subparsers.add_parser("faiss-index", help="IVF-Flat / IVF-PQ / HNSW variants of the DSSM flat Faiss index")
+    job.add_argument("--types", nargs="+", default=["ivf_flat", "ivf_pq", "hnsw"], choices=["flat", "ivf_flat", "ivf_pq", "hnsw"])
+    job.add_argument("--nlist", type=int, default=None, help="IVF lists (default 4 * sqrt(businesses))")
+    job.add_argument("--m", type=int, default=8, help="PQ sub-quantizers (must divide the embedding size)")
+    job.add_argument("--nbits", type=int, default=8, help="bits per PQ code")
+    job.add_argument("--hnsw-m", type=int, default=32, help="HNSW neighbours per node")
+    job.add_argument("--ef-construction", type=int, default=200, help="HNSW build-time search depth")
+    job.set_defaults(func=faiss_index)
+
+    job = subparsers.add_parser("faiss-benchmark", help="recall@k against the flat index and QPS for each built variant")
+    job.add_argument("--types", nargs="+", default=["flat", "ivf_flat", "ivf_pq", "hnsw"], choices=["flat", "ivf_flat", "ivf_pq", "hnsw"])
+    job.add_argument("--k", type=int, default=5000, help="k used by the DeepFM candidate stage")
+    job.add_argument("--queries", type=int, default=1000, help="number of sampled users")
+    job.add_argument("--nprobe", type=int, nargs="+", default=[1, 8, 32, 128])
+    job.add_argument("--ef-search", type=int, nargs="+", default=[128, 512, 2048, 8192])
+    job.add_argument("--seed", type=int, default=0)
+    job.set_defaults(func=faiss_benchmark)
+
+    job = subparsers.add_parser("yelp-indexes", help="indexes and per-business totals for the retrieve_info lookups on the Yelp databases, with before/after query plans (idempotent)")
+    job.add_argument("--dry-run", action="store_true", help="only report the missing indexes and the current plans")
+    job.set_defaults(func=yelp_indexes)
+
+    job = subparsers.add_parser("checkin-stats", help="per-business check-in counts by day of week, hour and month (re-run after data refreshes)")
+    job.set_defaults(func=checkin_stats)
+
+    args = parser.parse_args()
+    args.func(args)
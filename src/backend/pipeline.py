@@ -0,0 +1,155 @@
+import copy
+import json
+import os
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from retrieval import retrieve_candidates, Expected_concurrency
+
+# Budgets, timeouts (seconds) and source weights of the recommendation pipeline.
+# A deployment overrides any of them with a JSON file (same shape, only the keys to change),
+# found at $PIPELINE_CONFIG or pipeline_config.json next to this file.
+Default_pipeline_config = {
+    "sources": {
+        "ItemCF": {"enabled": True, "k": 300, "timeout": 1.0, "weight": 1.0},
+        "UserCF": {"enabled": True, "k": 500, "timeout": 1.0, "weight": 1.0},
+        "DSSM": {"enabled": True, "k": 5000, "timeout": 1.0, "weight": 1.0},
+    },
+    # weighted reciprocal-rank fusion of the source lists: sum of weight / (rrf_k + rank)
+    "merge": {"rrf_k": 60},
+    # cut of the merged candidates before the ranker: linear blend of the per-source scores
+    # (each scaled by its largest absolute value) and the business popularity prior
+    "prerank": {"enabled": True, "k": 800, "weights": {"ItemCF": 1.0, "UserCF": 1.0, "DSSM": 1.0, "popularity": 0.1}},
+    # on timeout the merged order is served instead of the ranker's
+    "rank": {"k": 100, "timeout": 2.0},
+}
+
+# The ranker has its own pool, so retrievers left running after a timeout never queue ahead of it
+# and ranker jobs never starve the sources. A ranker that misses its timeout keeps its thread too.
+Ranking_executor = ThreadPoolExecutor(max_workers=2 * Expected_concurrency, thread_name_prefix="ranking")
+
+Pipeline_config_path = os.environ.get("PIPELINE_CONFIG", os.path.join(os.path.dirname(os.path.abspath(__file__)), "pipeline_config.json"))
+
+def merge_config(config, overrides):
+    config = copy.deepcopy(config)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(config.get(key), dict):
+            config[key] = merge_config(config[key], value)
+        else:
+            config[key] = value
+    return config
+
+def load_pipeline_config(path=Pipeline_config_path):
+    if not os.path.exists(path):
+        return copy.deepcopy(Default_pipeline_config)
+    with open(path) as f:
+        return merge_config(Default_pipeline_config, json.load(f))
+
+# Weighted reciprocal-rank fusion; ties keep the order of first appearance (sources in config order)
+def merge_candidates(candidates, weights, rrf_k=60):
+    scores = {}
+    for name, recommendations in candidates.items():
+        weight = weights.get(name, 1.0)
+        for rank, (business_id, _) in enumerate(recommendations):
+            scores[business_id] = scores.get(business_id, 0) + weight / (rrf_k + rank + 1)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+# Vectorized linear blend of the source scores and the popularity prior, keeping the k best merged candidates
+def linear_prerank(candidates, merged, k, weights, popularity=None):
+    if len(merged) <= k:
+        return merged
+    business_ids = [business_id for business_id, _ in merged]
+    position = {business_id: i for i, business_id in enumerate(business_ids)}
+
+    scores = np.zeros(len(business_ids))
+    for name, recommendations in candidates.items():
+        weight = weights.get(name, 0)
+        if not weight or not recommendations:
+            continue
+        positions = np.fromiter((position[business_id] for business_id, _ in recommendations), dtype=np.int64, count=len(recommendations))
+        source_scores = np.fromiter((score for _, score in recommendations), dtype=np.float64, count=len(recommendations))
+        scale = np.abs(source_scores).max()
+        if scale > 0:
+            np.add.at(scores, positions, weight * source_scores / scale)
+    if popularity is not None and weights.get("popularity", 0):
+        scores += weights["popularity"] * np.asarray(popularity(business_ids), dtype=np.float64)
+
+    # stable, so ties keep the merged order
+    top = np.argsort(-scores, kind="stable")[:k]
+    return [(business_ids[i], float(scores[i])) for i in top]
+
+class StageTimer:
+    # Records one stage's wall time and candidate counts into the run's stage list
+    def __init__(self, stages, name, candidates_in):
+        self.record = {"stage": name, "candidates_in": candidates_in}
+        stages.append(self.record)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self.record
+
+    def __exit__(self, *exc_info):
+        self.record["ms"] = round((time.perf_counter() - self.start) * 1000, 2)
+
+class Pipeline:
+    # Retrieval sources -> merge/dedupe -> optional pre-rank cut -> ranker -> post-processing.
+    # sources: {name: function(user_id, k) -> [(business_id, score), ...]}
+    # ranker: function(context, business_ids, k) -> [(business_id, score), ...]
+    # post_processors: functions(context, recommendations) -> recommendations
+    # popularity: function(business_ids) -> prior per business, used by the pre-ranker
+    def __init__(self, sources, ranker, config=None, post_processors=(), popularity=None):
+        self.sources = sources
+        self.ranker = ranker
+        self.config = load_pipeline_config() if config is None else config
+        self.post_processors = list(post_processors)
+        self.popularity = popularity
+
+    def run(self, user_id, context=None):
+        config = self.config
+        context = dict(context or {}, user_id=user_id)
+        stages = []
+
+        source_config = {name: config["sources"][name] for name in self.sources if config["sources"].get(name, {}).get("enabled", True)}
+        with StageTimer(stages, "retrieval", 0) as stage:
+            candidates, report = retrieve_candidates(
+                {name: self.source_call(name, user_id, source["k"]) for name, source in source_config.items()},
+                {name: source["timeout"] for name, source in source_config.items()})
+            stage["candidates_out"] = sum(len(recommendations) for recommendations in candidates.values())
+
+        with StageTimer(stages, "merge", stage["candidates_out"]) as stage:
+            merged = merge_candidates(candidates, {name: source["weight"] for name, source in source_config.items()}, config["merge"]["rrf_k"])
+            stage["candidates_out"] = len(merged)
+
+        if config["prerank"]["enabled"]:
+            with StageTimer(stages, "prerank", len(merged)) as stage:
+                merged = self.prerank(context, candidates, merged, config["prerank"]["k"])
+                stage["candidates_out"] = len(merged)
+
+        k = config["rank"]["k"]
+        with StageTimer(stages, "rank", len(merged)) as stage:
+            recommendations, stage["status"] = self.rank(context, [business_id for business_id, _ in merged], merged, k, config["rank"]["timeout"])
+            stage["candidates_out"] = len(recommendations)
+
+        for post_processor in self.post_processors:
+            with StageTimer(stages, post_processor.__name__, len(recommendations)) as stage:
+                recommendations = post_processor(context, recommendations)
+                stage["candidates_out"] = len(recommendations)
+
+        return {"recommendations": recommendations, "sources": report, "stages": stages, "context": context}
+
+    def source_call(self, name, user_id, k):
+        source = self.sources[name]
+        return lambda: source(user_id, k)
+
+    def prerank(self, context, candidates, merged, k):
+        return linear_prerank(candidates, merged, k, self.config["prerank"]["weights"], self.popularity)
+
+    def rank(self, context, business_ids, merged, k, timeout):
+        if not business_ids:
+            return [], "empty"
+        future = Ranking_executor.submit(self.ranker, context, business_ids, k)
+        try:
+            return future.result(timeout=timeout), "ok"
+        except TimeoutError:
+            future.cancel()
+            return merged[:k], "timeout"
@@ -0,0 +1,142 @@
+import functools
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from flask import request, current_app
+from models.cache import LRUCache
+
+# Whole responses of the recommendation endpoints, keyed by (endpoint, user_id, k, model version).
+# Entries live Response_cache_ttl seconds; with $RESPONSE_CACHE_PATH set they are also written to a
+# local SQLite file, so a restarted backend serves them until they expire.
+Response_cache_ttl = 600
+Response_cache_maxsize = 4096
+# Rows kept in the SQLite file; the oldest are dropped first
+Response_cache_disk_maxsize = 100000
+Response_cache_path = os.environ.get("RESPONSE_CACHE_PATH")
+
+# Fingerprint (size and mtime) of the files matching the patterns; the models are loaded once at
+# import, so taking it at startup identifies the artifacts the process serves from
+def artifact_version(*patterns, config=None):
+    digest = hashlib.sha1()
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)):
+            if os.path.isfile(path):
+                stat = os.stat(path)
+                digest.update(f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    if config is not None:
+        digest.update(json.dumps(config, sort_keys=True).encode())
+    return digest.hexdigest()[:12]
+
+class SqliteResponseStore:
+    # key -> (created wall time, body) in a local SQLite file, shared by the request threads
+    def __init__(self, path, maxsize=Response_cache_disk_maxsize):
+        self.maxsize = maxsize
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute("PRAGMA synchronous = NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, created REAL, body TEXT)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_created ON responses (created)")
+        self._conn.commit()
+
+    def get(self, key):
+        with self._lock:
+            return self._conn.execute("SELECT created, body FROM responses WHERE key = ?", (key,)).fetchone()
+
+    def set(self, key, created, body, ttl):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (key, created, body))
+            self._writes += 1
+            # drop expired and surplus rows now and then
+            if self._writes % 100 == 0:
+                self._conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - ttl,))
+                self._conn.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY created DESC LIMIT -1 OFFSET ?)", (self.maxsize,))
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+
+class ResponseCache:
+    # LRU in memory, optionally written through to a SqliteResponseStore
+    def __init__(self, ttl=Response_cache_ttl, maxsize=Response_cache_maxsize, path=Response_cache_path):
+        self.ttl = ttl
+        # the entries carry their creation time, so the age is checked here rather than by the LRU
+        self.memory = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.store = SqliteResponseStore(path) if path else None
+        self.disk_hits = 0
+
+    def get(self, key):
+        entry = self.memory.get(key)
+        if entry is None and self.store is not None:
+            entry = self.store.get(key)
+            if entry is not None and time.time() - entry[0] < self.ttl:
+                self.disk_hits += 1
+                self.memory.set(key, entry)
+        if entry is None or time.time() - entry[0] >= self.ttl:
+            return None
+        return entry[1]
+
+    def set(self, key, body):
+        entry = (time.time(), body)
+        self.memory.set(key, entry)
+        if self.store is not None:
+            self.store.set(key, entry[0], body, self.ttl)
+
+    def clear(self):
+        self.memory.clear()
+        if self.store is not None:
+            self.store.clear()
+
+    def stats(self):
+        return dict(self.memory.stats(), disk=self.store is not None, disk_hits=self.disk_hits)
+
+Response_cache = ResponseCache()
+
+def response_key(endpoint, user_id, k, version):
+    return json.dumps([endpoint, user_id, k, version])
+
+# Body stored for a fresh answer: the per-request fields (e.g. latency diagnostics) are left out and the
+# body is marked "cached", so a replay does not pass off the original timings as its own
+def cached_body(body, uncached_fields):
+    payload = json.loads(body)
+    for field in uncached_fields:
+        payload.pop(field, None)
+    payload["cached"] = True
+    return json.dumps(payload)
+
+# Serve the endpoint's cached JSON body for the request's (user_id, k), or call it and cache a 200 answer.
+# version is a string or a function returning one (the model version).
+# uncached_fields are top-level response fields measured per request, dropped from the cached body.
+def cached_response(endpoint, version, default_k=None, cache=None, uncached_fields=()):
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper():
+            response_cache = Response_cache if cache is None else cache
+            data = request.get_json(silent=True) or {}
+            user_id, k = data.get('user_id'), data.get('k', default_k)
+            try:
+                k = None if k is None else int(k)
+            except (TypeError, ValueError):
+                # let the endpoint report the bad request
+                return view()
+            if not user_id:
+                return view()
+
+            key = response_key(endpoint, user_id, k, version() if callable(version) else version)
+            body = response_cache.get(key)
+            if body is not None:
+                return current_app.response_class(body, mimetype="application/json"), 200
+            response, status = view()
+            # the endpoint opts out of caching an answer with Cache-Control: no-store
+            if status == 200 and not response.cache_control.no_store:
+                response_cache.set(key, cached_body(response.get_data(as_text=True), uncached_fields))
+            return response, status
+        return wrapper
+    return decorator
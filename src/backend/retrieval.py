@@ -0,0 +1,41 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+# Number of recommendation requests expected to run at the same time ($RECOMMENDATION_CONCURRENCY)
+Expected_concurrency = int(os.environ.get("RECOMMENDATION_CONCURRENCY", 8))
+Retrieval_sources_per_request = 3
+
+# Shared pool for the candidate retrievers. A retriever that misses its timeout keeps its thread
+# until it finishes, so the pool has room for twice the sources of the expected concurrent requests.
+Retrieval_executor = ThreadPoolExecutor(max_workers=2 * Expected_concurrency * Retrieval_sources_per_request, thread_name_prefix="retrieval")
+Retrieval_default_timeout = 1.0
+
+# Run the retrievers concurrently; each gets its own timeout measured from the start of the fan-out.
+# sources is {name: function returning [(business_id, score), ...]}.
+# Returns the results of the sources that finished in time and a report for every source.
+# timeouts is {name: seconds}; a source missing from it gets Retrieval_default_timeout.
+def retrieve_candidates(sources, timeouts):
+    start = time.monotonic()
+    futures = {name: Retrieval_executor.submit(timed, source) for name, source in sources.items()}
+
+    results = {}
+    report = {}
+    for name, future in futures.items():
+        timeout = timeouts.get(name, Retrieval_default_timeout)
+        remaining = max(0, start + timeout - time.monotonic())
+        try:
+            recommendations, elapsed = future.result(timeout=remaining)
+            results[name] = recommendations
+            report[name] = {"status": "ok", "count": len(recommendations), "ms": round(elapsed * 1000, 2)}
+        except TimeoutError:
+            future.cancel()
+            report[name] = {"status": "timeout", "count": 0, "ms": round(timeout * 1000, 2)}
+        except Exception as e:
+            report[name] = {"status": "error", "count": 0, "error": str(e)}
+    return results, report
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
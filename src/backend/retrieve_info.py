@@ -1,4 +1,11 @@
+import base64
+import json
 import sqlite3
+import numpy as np
+from contextlib import ExitStack
+from itertools import groupby
+from models.connections import pooled_connection, IdFilter, has_table
+from models.cache import LRUCache
 
 yelp_data_path = '../../data/processed_data/yelp_data/'
 db_path_business = yelp_data_path + 'yelp_business_data.db'
@@ -6,193 +13,400 @@ db_path_review = yelp_data_path + 'yelp_review_data.db'
 db_path_user = yelp_data_path + 'yelp_user_data.db'
 db_path_tip = yelp_data_path + 'yelp_tip_data.db'
 
-def retrieve_business_info(business_ids, db_path_business=db_path_business, db_path_review=db_path_review, db_path_user=db_path_user, db_path_tip=db_path_tip):
-    # Connect to databases
-    conn_business = sqlite3.connect(db_path_business)
-    conn_review = sqlite3.connect(db_path_review)
-    conn_user = sqlite3.connect(db_path_user)
-    conn_tip = sqlite3.connect(db_path_tip)
+# Fields retrieve_business_info can return; columns of business_details, lists filled from the other tables,
+# avg_review (mean review stars, 0 without reviews) computed in SQL and checkin_stats (check-in histograms)
+business_detail_fields = ["business_id", "name", "address", "city", "state", "postal_code", "latitude", "longitude",
+                          "stars", "review_count", "is_open", "attributes", "hours"]
+business_list_fields = ["categories", "reviews", "tips", "checkins"]
+business_fields = business_detail_fields + business_list_fields + ["avg_review", "checkin_stats"]
+
+# Everything shown for a business (the default); the raw check-in rows only when asked for with the checkins field
+business_display_fields = business_detail_fields + ["categories", "reviews", "tips", "checkin_stats"]
+
+# Reviews and tips attached per business, newest first; the rest are paged with the returned cursors
+Business_review_limit = 5
+Business_tip_limit = 5
+
+# Paged lists: table, columns returned per row, precomputed totals table (built by the yelp-indexes job) and its count column
+business_pages = {
+    "reviews": ("review_data", ["review_id", "user_id", "stars", "date", "text", "useful", "funny", "cool"], "business_review_stats", "review_count"),
+    "tips": ("tip_data", ["user_id", "text", "date", "compliment_count"], "business_tip_stats", "tip_count"),
+}
+
+# Read-through caches of the business / user info by id and view (fields, limits and databases), bounded by
+# entries and by JSON size. Cached dicts are shared between requests, so callers must not modify them.
+# Ids missing from the databases are cached too (as None). Paged requests (with cursors) are not cached.
+Info_cache_ttl = 300
+def json_size(value):
+    return len(json.dumps(value, default=str))
+Business_info_cache = LRUCache(maxsize=20000, ttl=Info_cache_ttl, maxbytes=128 * 1024 * 1024, sizeof=json_size)
+User_info_cache = LRUCache(maxsize=20000, ttl=Info_cache_ttl, maxbytes=64 * 1024 * 1024, sizeof=json_size)
+
+# Invalidation hooks, e.g. after a data refresh; None drops everything
+def invalidate_business_info(business_ids=None):
+    if business_ids is None:
+        Business_info_cache.clear()
+        return
+    business_ids = set(business_ids)
+    Business_info_cache.invalidate(lambda key: key[0] in business_ids)
+
+def invalidate_user_info(user_ids=None):
+    if user_ids is None:
+        User_info_cache.clear()
+        return
+    user_ids = {user_ids} if type(user_ids) == str else set(user_ids)
+    User_info_cache.invalidate(lambda key: key[0] in user_ids)
+
+def info_cache_stats():
+    return {"business_info": Business_info_cache.stats(), "user_info": User_info_cache.stats()}
+
+# Serve the cached ids of a batch and query only the misses; query(ids) returns ({id: info}, complete),
+# and only complete results are cached
+def read_through(cache, ids, view, query):
+    ids = list(dict.fromkeys(ids))
+    cached = cache.get_many([(key, view) for key in ids])
+    missing = [key for key in ids if (key, view) not in cached]
+    queried = {}
+    if missing:
+        queried, complete = query(missing)
+        if complete:
+            cache.set_many({(key, view): queried.get(key) for key in missing})
+    info = {}
+    for key in ids:
+        value = cached[(key, view)] if (key, view) in cached else queried.get(key)
+        if value is not None:
+            info[key] = value
+    return info
+
+# Check-in histograms per business, built offline from checkin_data by the checkin-stats job
+Checkin_stats_table = "business_checkin_stats"
+checkin_stats_columns = ["total", "first", "last", "day_of_week", "hour", "month"]
+
+# Check-in counts from checkin_data values (comma-separated "YYYY-MM-DD HH:MM:SS" timestamps): total, first and last
+# timestamp, and counts by day of week (Monday first), hour of day and month (January first)
+def checkin_stats(checkin_dates):
+    dates = [date.strip() for text in checkin_dates if text for date in text.split(",") if date.strip()]
+    if not dates:
+        return {"total": 0, "first": None, "last": None, "day_of_week": [0] * 7, "hour": [0] * 24, "month": [0] * 12}
+    seconds = np.array(dates, dtype="datetime64[s]").astype(np.int64)
+    return {
+        "total": len(dates),
+        "first": min(dates),
+        "last": max(dates),
+        # 1970-01-01 was a Thursday
+        "day_of_week": np.bincount((seconds // 86400 + 3) % 7, minlength=7).tolist(),
+        "hour": np.bincount(seconds // 3600 % 24, minlength=24).tolist(),
+        "month": np.bincount(np.array(dates, dtype="datetime64[M]").astype(np.int64) % 12, minlength=12).tolist(),
+    }
+
+# Rebuild the check-in histograms table in the business database; returns the number of businesses
+def build_checkin_stats(db_path_business=db_path_business):
+    conn = sqlite3.connect(db_path_business)
+    try:
+        # one business's rows at a time; the histograms are small, the raw timestamps are not
+        rows = conn.execute("SELECT business_id, checkin_date FROM checkin_data ORDER BY business_id")
+        stats = [(business_id, checkin_stats(checkin_date for _, checkin_date in checkins)) for business_id, checkins in groupby(rows, key=lambda row: row[0])]
+        conn.execute(f"DROP TABLE IF EXISTS {Checkin_stats_table}")
+        conn.execute(f"""CREATE TABLE {Checkin_stats_table} (business_id TEXT PRIMARY KEY, total INTEGER, first TEXT, last TEXT,
+                         day_of_week TEXT, hour TEXT, month TEXT)""")
+        conn.executemany(f"INSERT INTO {Checkin_stats_table} VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         ([business_id, business_stats["total"], business_stats["first"], business_stats["last"],
+                           json.dumps(business_stats["day_of_week"]), json.dumps(business_stats["hour"]), json.dumps(business_stats["month"])]
+                          for business_id, business_stats in stats))
+        conn.commit()
+        return len(stats)
+    finally:
+        conn.close()
+
+# Opaque paging cursor: the list, the business and the (date, rowid) of the last row served
+def encode_cursor(field, business_id, date, rowid):
+    return base64.urlsafe_b64encode(json.dumps([field, business_id, date, rowid]).encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        field, business_id, date, rowid = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError, AttributeError):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    if field not in business_pages:
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return field, business_id, (date, rowid)
+
+# One page of a business's reviews or tips, newest first, after the (date, rowid) position if given.
+# Served from the (business_id, date) index without sorting. Returns the rows and the cursor of the next page, if any.
+def retrieve_page(conn, field, business_id, limit, after=None):
+    table, columns = business_pages[field][:2]
+    condition, params = "business_id = ?", [business_id]
+    if after is not None:
+        condition += " AND (date, rowid) < (?, ?)"
+        params += list(after)
+    query = f"SELECT rowid, {', '.join(columns)} FROM {table} WHERE {condition} ORDER BY date DESC, rowid DESC LIMIT ?"
+    return page_of(field, business_id, conn.execute(query, params + [limit + 1]).fetchall(), limit)
+
+# First page of every business's reviews or tips in one query: {business_id: (items, cursor)}.
+# Businesses without any rows are left out.
+def retrieve_first_pages(conn, field, business_filter, limit):
+    table, columns = business_pages[field][:2]
+    condition, params = business_filter.where(conn, "business_id")
+    query = f"""
+    SELECT business_id, row_id, {', '.join(columns)} FROM (
+        SELECT business_id, rowid AS row_id, {', '.join(columns)},
+               ROW_NUMBER() OVER (PARTITION BY business_id ORDER BY date DESC, rowid DESC) AS position
+        FROM {table}
+        WHERE {condition}
+    )
+    WHERE position <= ?
+    ORDER BY business_id, position
+    """
+    pages = {}
+    for business_id, rows in groupby(conn.execute(query, params + [limit + 1]), key=lambda row: row[0]):
+        pages[business_id] = page_of(field, business_id, [row[1:] for row in rows], limit)
+    return pages
+
+# Items and next-page cursor from up to limit + 1 (rowid, *columns) rows, newest first
+def page_of(field, business_id, rows, limit):
+    columns = business_pages[field][1]
+    items = [dict(zip(columns, row[1:])) for row in rows[:limit]]
+    cursor = None
+    if len(rows) > limit and limit > 0:
+        last = rows[limit - 1]
+        cursor = encode_cursor(field, business_id, last[1 + columns.index("date")], last[0])
+    return items, cursor
+
+# All reviews or tips of the businesses, newest first per business
+def retrieve_all(conn, field, business_filter):
+    table, columns = business_pages[field][:2]
+    condition, params = business_filter.where(conn, "business_id")
+    query = f"SELECT business_id, {', '.join(columns)} FROM {table} WHERE {condition} ORDER BY business_id, date DESC, rowid DESC"
+    items = {}
+    for row in conn.execute(query, params):
+        items.setdefault(row[0], []).append(dict(zip(columns, row[1:])))
+    return items
+
+# Number of reviews or tips per business, from the precomputed totals table when the database has it
+def retrieve_totals(conn, field, business_filter):
+    table, _, totals_table, count_column = business_pages[field]
+    condition, params = business_filter.where(conn, "business_id")
+    if has_table(conn, totals_table):
+        query = f"SELECT business_id, {count_column} FROM {totals_table} WHERE {condition}"
+    else:
+        query = f"SELECT business_id, COUNT(*) FROM {table} WHERE {condition} GROUP BY business_id"
+    return dict(conn.execute(query, params).fetchall())
+
+def retrieve_business_info(business_ids, db_path_business=db_path_business, db_path_review=db_path_review, db_path_user=db_path_user, db_path_tip=db_path_tip, fields=None,
+                           review_limit=Business_review_limit, tip_limit=Business_tip_limit, cursors=None):
+    # Only the requested fields are read, e.g. fields=['stars', 'review_count', 'latitude', 'longitude']
+    fields = business_display_fields if fields is None else list(fields)
+    query = lambda ids: query_business_info(ids, db_path_business, db_path_review, db_path_tip, fields, review_limit, tip_limit, cursors)
+    if cursors:
+        return query(business_ids)[0]
+    view = (tuple(fields), review_limit, tip_limit, db_path_business, db_path_review, db_path_tip)
+    return read_through(Business_info_cache, business_ids, view, query)
+
+# SQLite side of retrieve_business_info; also returns whether every query succeeded
+def query_business_info(business_ids, db_path_business, db_path_review, db_path_tip, fields, review_limit, tip_limit, cursors):
+    unknown_fields = set(fields) - set(business_fields)
+    if unknown_fields:
+        raise ValueError(f"Unknown business fields: {sorted(unknown_fields)}")
+    # At most review_limit reviews and tip_limit tips per business (None for all), with their totals and the
+    # cursor of the next page; cursors returned by an earlier call continue those businesses' lists
+    limits = {"reviews": review_limit, "tips": tip_limit}
+    if any(limit is not None and limit < 0 for limit in limits.values()):
+        raise ValueError("Review and tip limits must be non-negative")
+    positions = {}
+    for cursor in cursors or []:
+        field, business_id, after = decode_cursor(cursor)
+        positions[(field, business_id)] = after
+    detail_fields = ["business_id"] + [field for field in business_detail_fields if field in fields and field != "business_id"]
+    list_fields = [field for field in business_list_fields if field in fields]
+    # IN list for short id lists, temp table join for bulk lookups
+    business_filter = IdFilter(business_ids)
 
     business_info = {}
+    complete = False
 
     try:
-        # Fetch business details including the new fields: categories, attributes, hours
-        business_details_query = f"""
-        SELECT b.business_id, b.name, b.address, b.city, b.state, b.postal_code, b.latitude, b.longitude, 
-               b.stars, b.review_count, b.is_open, b.attributes, b.hours
-        FROM business_details b
-        WHERE b.business_id IN ({','.join(['?' for _ in business_ids])})
-        """
-        cursor = conn_business.execute(business_details_query, business_ids)
-        business_details = cursor.fetchall()
-
-        # Add business details to result, including attributes and hours
-        for business in business_details:
-            business_id = business[0]
-            business_info[business_id] = {
-                "business_id": business_id,
-                "name": business[1],
-                "address": business[2],
-                "city": business[3],
-                "state": business[4],
-                "postal_code": business[5],
-                "latitude": business[6],
-                "longitude": business[7],
-                "stars": business[8],
-                "review_count": business[9],
-                "is_open": business[10],
-                "attributes": business[11],
-                "hours": business[12],
-                "categories": [],  # Placeholder for categories
-                "reviews": [],
-                "tips": [],
-                "checkins": []
-            }
-
-        # Fetch categories for each business
-        category_query = f"""
-        SELECT business_id, category
-        FROM business_categories
-        WHERE business_id IN ({','.join(['?' for _ in business_ids])})
-        """
-        cursor = conn_business.execute(category_query, business_ids)
-        categories = cursor.fetchall()
-
-        # Add categories to corresponding businesses
-        for category in categories:
-            business_id = category[0]
-            if business_id in business_info:
-                business_info[business_id]['categories'].append(category[1])
-
-        # Fetch reviews
-        review_query = f"SELECT * FROM review_data WHERE business_id IN ({','.join(['?' for _ in business_ids])})"
-        cursor = conn_review.execute(review_query, business_ids)
-        reviews = cursor.fetchall()
-
-        # Add reviews to corresponding businesses
-        for review in reviews:
-            business_id = review[2]
-            review_data = {
-                "review_id": review[0],
-                "user_id": review[1],
-                "stars": review[3],
-                "date": review[4],
-                "text": review[5],
-                "useful": review[6],
-                "funny": review[7],
-                "cool": review[8]
-            }
-            if business_id in business_info:
-                business_info[business_id]['reviews'].append(review_data)
-
-        # Fetch tips
-        tip_query = f"SELECT * FROM tip_data WHERE business_id IN ({','.join(['?' for _ in business_ids])})"
-        cursor = conn_tip.execute(tip_query, business_ids)
-        tips = cursor.fetchall()
-
-        # Add tips to corresponding businesses
-        for tip in tips:
-            business_id = tip[1]
-            tip_data = {
-                "user_id": tip[0],
-                "text": tip[2],
-                "date": tip[3],
-                "compliment_count": tip[4]
-            }
-            if business_id in business_info:
-                business_info[business_id]['tips'].append(tip_data)
-
-        # Fetch check-ins
-        checkin_query = f"SELECT * FROM checkin_data WHERE business_id IN ({','.join(['?' for _ in business_ids])})"
-        cursor = conn_business.execute(checkin_query, business_ids)
-        checkins = cursor.fetchall()
-
-        # Add check-in data to corresponding businesses
-        for checkin in checkins:
-            business_id = checkin[0]
-            checkin_data = {
-                "checkin_date": checkin[1]
-            }
-            if business_id in business_info:
-                business_info[business_id]['checkins'].append(checkin_data)
+        # Pooled read-only connections to the databases the fields need. Leaving the block returns them
+        # to the pool; a sqlite3.DatabaseError passes through it first, so the pool closes them instead.
+        with ExitStack() as connections:
+            conn_business = connections.enter_context(pooled_connection(db_path_business))
+            conn_review = connections.enter_context(pooled_connection(db_path_review)) if "reviews" in fields or "avg_review" in fields else None
+            conn_tip = connections.enter_context(pooled_connection(db_path_tip)) if "tips" in fields else None
+
+            # Fetch business details
+            condition, params = business_filter.where(conn_business, "b.business_id")
+            business_details_query = f"""
+            SELECT {', '.join('b.' + field for field in detail_fields)}
+            FROM business_details b
+            WHERE {condition}
+            """
+            cursor = conn_business.execute(business_details_query, params)
+            business_details = cursor.fetchall()
+
+            # Add business details to result, with empty lists for the list fields
+            for business in business_details:
+                business_id = business[0]
+                business_info[business_id] = dict(zip(detail_fields, business))
+                for field in list_fields:
+                    business_info[business_id][field] = []
+                if "avg_review" in fields:
+                    business_info[business_id]["avg_review"] = 0
+                if "checkin_stats" in fields:
+                    business_info[business_id]["checkin_stats"] = checkin_stats([])
+
+            if "categories" in fields:
+                # Fetch categories for each business
+                condition, params = business_filter.where(conn_business, "business_id")
+                category_query = f"""
+                SELECT business_id, category
+                FROM business_categories
+                WHERE {condition}
+                """
+                cursor = conn_business.execute(category_query, params)
+                categories = cursor.fetchall()
+
+                # Add categories to corresponding businesses
+                for category in categories:
+                    business_id = category[0]
+                    if business_id in business_info:
+                        business_info[business_id]['categories'].append(category[1])
+
+            if "avg_review" in fields:
+                condition, params = business_filter.where(conn_review, "business_id")
+                if has_table(conn_review, "business_review_stats"):
+                    avg_review_query = f"SELECT business_id, avg_stars FROM business_review_stats WHERE {condition}"
+                else:
+                    avg_review_query = f"SELECT business_id, AVG(stars) FROM review_data WHERE {condition} GROUP BY business_id"
+                for business_id, avg_review in conn_review.execute(avg_review_query, params):
+                    if business_id in business_info:
+                        business_info[business_id]["avg_review"] = avg_review
+
+            for field, conn in (("reviews", conn_review), ("tips", conn_tip)):
+                if field not in fields:
+                    continue
+                # Fetch the totals and the newest reviews / tips
+                item = field[:-1]
+                totals = retrieve_totals(conn, field, business_filter)
+                all_items = retrieve_all(conn, field, business_filter) if limits[field] is None else {}
+                # first pages in one query; only businesses continued from a cursor are paged one by one
+                first_pages = retrieve_first_pages(conn, field, business_filter, limits[field]) if limits[field] is not None else {}
+                for business_id, info in business_info.items():
+                    info[f"{item}_total"] = totals.get(business_id, 0)
+                    if limits[field] is None:
+                        info[field], info[f"{item}_cursor"] = all_items.get(business_id, []), None
+                    elif (field, business_id) in positions:
+                        info[field], info[f"{item}_cursor"] = retrieve_page(conn, field, business_id, limits[field], positions[(field, business_id)])
+                    else:
+                        info[field], info[f"{item}_cursor"] = first_pages.get(business_id, ([], None))
+
+            if "checkins" in fields:
+                # Fetch check-ins
+                condition, params = business_filter.where(conn_business, "business_id")
+                checkin_query = f"SELECT business_id, checkin_date FROM checkin_data WHERE {condition}"
+                cursor = conn_business.execute(checkin_query, params)
+                checkins = cursor.fetchall()
+
+                # Add check-in data to corresponding businesses
+                for checkin in checkins:
+                    business_id = checkin[0]
+                    checkin_data = {
+                        "checkin_date": checkin[1]
+                    }
+                    if business_id in business_info:
+                        business_info[business_id]['checkins'].append(checkin_data)
 
+            if "checkin_stats" in fields:
+                # Fetch the check-in histograms, aggregating the raw rows if the table has not been built
+                condition, params = business_filter.where(conn_business, "business_id")
+                if has_table(conn_business, Checkin_stats_table):
+                    checkin_stats_query = f"SELECT business_id, {', '.join(checkin_stats_columns)} FROM {Checkin_stats_table} WHERE {condition}"
+                    for business_id, total, first, last, day_of_week, hour, month in conn_business.execute(checkin_stats_query, params):
+                        if business_id in business_info:
+                            business_info[business_id]["checkin_stats"] = {"total": total, "first": first, "last": last, "day_of_week": json.loads(day_of_week),
+                                                                           "hour": json.loads(hour), "month": json.loads(month)}
+                else:
+                    checkin_query = f"SELECT business_id, checkin_date FROM checkin_data WHERE {condition} ORDER BY business_id"
+                    for business_id, checkins in groupby(conn_business.execute(checkin_query, params), key=lambda row: row[0]):
+                        if business_id in business_info:
+                            business_info[business_id]["checkin_stats"] = checkin_stats(checkin_date for _, checkin_date in checkins)
+
+            complete = True
     except Exception as e:
         print(f"Error retrieving business info: {str(e)}")
 
-    finally:
-        # Close database connections
-        conn_business.close()
-        conn_review.close()
-        conn_user.close()
-        conn_tip.close()
+    return business_info, complete
 
-    return business_info
+# Display path: full details and the newest reviews / tips, for the few businesses actually returned to the client
+def retrieve_business_display_info(business_ids):
+    return retrieve_business_info(business_ids, fields=business_display_fields)
 
 
 def retrieve_user_info(user_ids, db_path_user=db_path_user):
-    # Connect to the database
-    conn_user = sqlite3.connect(db_path_user)
-    user_info = {}
-
     # Convert user_ids to a list if it's a single string
     if type(user_ids) == str:
         user_ids = [user_ids]
+    return read_through(User_info_cache, user_ids, db_path_user, lambda ids: query_user_info(ids, db_path_user))
+
+# SQLite side of retrieve_user_info; also returns whether the query succeeded
+def query_user_info(user_ids, db_path_user=db_path_user):
+    user_info = {}
+    complete = False
 
     try:
-        # Fetch user details including the new fields
-        user_details_query = f"""
-        SELECT user_id, name, review_count, yelping_since, useful, funny, cool, fans,
-               average_stars, friends, elite, compliment_hot, compliment_more,
-               compliment_profile, compliment_cute, compliment_list, compliment_note,
-               compliment_plain, compliment_cool, compliment_funny,
-               compliment_writer, compliment_photos, categories
-        FROM user_data
-        WHERE user_id IN ({','.join(['?' for _ in user_ids])})
-        """
-        cursor = conn_user.execute(user_details_query, user_ids)
-        user_details = cursor.fetchall()
-
-        # Add user details to result
-        for user in user_details:
-            user_id = user[0]
-            user_info[user_id] = {
-                "user_id": user_id,
-                "name": user[1],
-                "review_count": user[2],
-                "yelping_since": user[3],
-                "useful": user[4],
-                "funny": user[5],
-                "cool": user[6],
-                "fans": user[7],
-                "average_stars": user[8],
-                "friends": [],
-                "elite": [],
-                "compliments": {
-                    "hot": user[11],
-                    "more": user[12],
-                    "profile": user[13],
-                    "cute": user[14],
-                    "list": user[15],
-                    "note": user[16],
-                    "plain": user[17],
-                    "cool": user[18],
-                    "funny": user[19],
-                    "writer": user[20],
-                    "photos": user[21],
+        # Pooled read-only connection, closed by the pool instead of returned if a query raises sqlite3.DatabaseError
+        with pooled_connection(db_path_user) as conn_user:
+
+            # Fetch user details including the new fields
+            condition, params = IdFilter(user_ids).where(conn_user, "user_id")
+            user_details_query = f"""
+            SELECT user_id, name, review_count, yelping_since, useful, funny, cool, fans,
+                   average_stars, friends, elite, compliment_hot, compliment_more,
+                   compliment_profile, compliment_cute, compliment_list, compliment_note,
+                   compliment_plain, compliment_cool, compliment_funny,
+                   compliment_writer, compliment_photos, categories
+            FROM user_data
+            WHERE {condition}
+            """
+            cursor = conn_user.execute(user_details_query, params)
+            user_details = cursor.fetchall()
+
+            # Add user details to result
+            for user in user_details:
+                user_id = user[0]
+                user_info[user_id] = {
+                    "user_id": user_id,
+                    "name": user[1],
+                    "review_count": user[2],
+                    "yelping_since": user[3],
+                    "useful": user[4],
+                    "funny": user[5],
+                    "cool": user[6],
+                    "fans": user[7],
+                    "average_stars": user[8],
+                    "friends": [],
+                    "elite": [],
+                    "compliments": {
+                        "hot": user[11],
+                        "more": user[12],
+                        "profile": user[13],
+                        "cute": user[14],
+                        "list": user[15],
+                        "note": user[16],
+                        "plain": user[17],
+                        "cool": user[18],
+                        "funny": user[19],
+                        "writer": user[20],
+                        "photos": user[21],
+                    }
                 }
-            }
-            if user[9]:
-                user_info[user_id]["friends"] = user[9].split(',')
-            if user[10]:
-                user_info[user_id]["elite"] = user[10].split(',')
-            if user[22]:
-                categories_lst = user[22].replace("[", "").replace("]", "").replace("\"", "").split(",")
-                user_info[user_id]["categories"] = [category.strip() for category in categories_lst]
+                if user[9]:
+                    user_info[user_id]["friends"] = user[9].split(',')
+                if user[10]:
+                    user_info[user_id]["elite"] = user[10].split(',')
+                if user[22]:
+                    categories_lst = user[22].replace("[", "").replace("]", "").replace("\"", "").split(",")
+                    user_info[user_id]["categories"] = [category.strip() for category in categories_lst]
+            complete = True
     except Exception as e:
         print(f"Error retrieving user info: {str(e)}")
 
-    finally:
-        # Close database connection
-        conn_user.close()
-
-    return user_info
\ No newline at end of file
+    return user_info, complete
\ No newline at end of file
@@ -1,5 +1,5 @@
 from flask import render_template, request
-from api import get_ItemCF_recommendations, get_UserCF_recommendations, get_DSSM_recommendations, get_DeepFM_recommendations, get_Cluster_recommendations, get_business_info, get_user_info
+from api import get_ItemCF_recommendations, get_UserCF_recommendations, get_DSSM_recommendations, get_DeepFM_recommendations, get_Cluster_recommendations, get_business_info, get_user_info, get_cache_stats
 
 def create_routes(app):
     """
@@ -59,3 +59,7 @@ def create_routes(app):
         if request.method == 'OPTIONS':
             return '', 200
         return get_user_info()
+
+    @app.route('/cache_stats', methods=['GET'])
+    def cache_stats():
+        return get_cache_stats()
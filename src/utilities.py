@@ -6,6 +6,7 @@ import pandas as pd
 import numpy as np
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import confusion_matrix
+from backend.models.id_mapping import as_id_mapping
 
 def check_py_version():
     print("this utilities.py updated on 3.30.22:43")
@@ -106,13 +107,16 @@ def get_top_k_similar_businesses(business_id, business_mapping, conn, k=100):
     top_k = sorted(zip(indices, data), key=lambda x: -x[1])[:k]
 
     # Map indices to business ids
-    similar_businesses = [(list(business_mapping.keys())[idx], score) for idx, score in top_k]
+    business_ids = as_id_mapping(business_mapping)
+    similar_businesses = [(business_ids.id_of(idx), score) for idx, score in top_k]
 
     return similar_businesses
 
 
 # Function to predict user interests based on similar businesses
 def predict_user_interests(user_id, business_mapping, conn, k=100):       # k is the number of recommendations to make
+    # one IdMapping for all the history businesses, not one per get_top_k_similar_businesses call
+    business_mapping = as_id_mapping(business_mapping)
     user_businesses = get_user_businesses(user_id, conn)
 
     recommended_businesses = {}
@@ -168,6 +172,7 @@ def get_business_interest(user_id, business_id, business_mapping, conn, k=100):
 
 
 def simulate_recommendations(test_data_grouped, user_mapping, business_mapping, conn, k=300, num_users=10):
+    business_mapping = as_id_mapping(business_mapping)
     # get the recommendations for each user in the test data
     recommendations = {}
 
@@ -265,6 +270,7 @@ def compute_evaluation_metric(true_positive, true_negative, false_positive, fals
 
 
 def predict_recommendations(test_data, test_data_grouped,business_mapping, conn, pos=4):
+    business_mapping = as_id_mapping(business_mapping)
     # optimized code (run time: 4m)
     # Initialize lists to store predictions and actual values
     predicted_labels = []